@@ -0,0 +1,90 @@
+"""Handshake micro benchmark
+
+Feeds a browser-like upgrade request to fresh WebSocket instances the way
+a reconnect storm does and reports handshakes per second. --chunk splits
+the request into small reads, which is the worst case for rescanning the
+header buffer.
+
+    python benchmarks/bench_handshake.py --handshakes 50000 --chunk 16
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from websocketproxy import exceptions  # noqa: E402
+from websocketproxy.websocketbase import WebSocket  # noqa: E402
+
+
+REQUEST = (
+    b'GET /attach?token=0123456789abcdef HTTP/1.1\r\n'
+    b'Host: proxy.example.com:8000\r\n'
+    b'Connection: Upgrade\r\n'
+    b'Pragma: no-cache\r\n'
+    b'Cache-Control: no-cache\r\n'
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+    b'(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36\r\n'
+    b'Upgrade: websocket\r\n'
+    b'Origin: https://console.example.com\r\n'
+    b'Sec-WebSocket-Version: 13\r\n'
+    b'Accept-Encoding: gzip, deflate, br\r\n'
+    b'Accept-Language: en-US,en;q=0.9\r\n'
+    b'Cookie: session=%s\r\n'
+    b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+    b'Sec-WebSocket-Extensions: permessage-deflate; '
+    b'client_max_window_bits\r\n'
+    b'\r\n')
+
+
+class NullProxy(object):
+    """Stands in for the proxy, nothing is attached upstream."""
+
+    def _attachTarget(self, client):
+        pass
+
+
+def run(handshakes, chunk, cookie):
+    request = REQUEST % (b'x' * cookie)
+    pieces = [request[i:i + chunk] for i in range(0, len(request), chunk)]
+    proxy = NullProxy()
+
+    start = time.time()
+    for i in range(handshakes):
+        client = WebSocket(proxy, None, None)
+        for piece in pieces:
+            client._processData(piece, proxy)
+        if not client.handshaked:
+            raise RuntimeError('handshake did not complete')
+    elapsed = time.time() - start
+
+    return {
+        'handshakes': handshakes,
+        'request_bytes': len(request),
+        'reads_per_handshake': len(pieces),
+        'handshakes_per_sec': handshakes / elapsed,
+        'usec_per_handshake': elapsed / handshakes * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--handshakes', type=int, default=20000)
+    parser.add_argument('--chunk', type=int, default=4096,
+                        help='bytes of the request delivered per read')
+    parser.add_argument('--cookie', type=int, default=512,
+                        help='size of the Cookie header')
+    args = parser.parse_args()
+
+    try:
+        result = run(args.handshakes, args.chunk, args.cookie)
+    except exceptions.WebSocketException as e:
+        sys.exit(str(e))
+    for key in sorted(result):
+        print('%-20s %s' % (key, result[key]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Idle connection memory benchmark
+
+Builds the Python side of many idle sessions the way the proxy holds
+them: a WebSocket past the handshake, its WebSocketClient target with an
+attach socket, and the loop's ConnectionPair, Upstream and keepalive
+timer. Reports the bytes tracemalloc attributes to each session, which
+leaves out the kernel socket buffers. Python 3 only.
+
+    python benchmarks/bench_memory.py --connections 5000
+"""
+
+import argparse
+import gc
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+try:
+    import tracemalloc
+except ImportError:
+    sys.exit('tracemalloc needs Python 3')
+
+from bench_handshake import REQUEST  # noqa: E402
+from websocketproxy import timers  # noqa: E402
+from websocketproxy.websocketbase import WebSocket  # noqa: E402
+from websocketproxy.websocketclient import WebSocketClient  # noqa: E402
+from websocketproxy.websocketproxy import ConnectionPair  # noqa: E402
+from websocketproxy.websocketproxy import Upstream  # noqa: E402
+
+
+class AttachSocket(object):
+    """Stands in for the websocket-client connection of a target."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+
+class NullProxy(object):
+    """Attaches targets the way WebSocketProxy does, without a loop."""
+
+    def __init__(self):
+        self.timers = timers.TimerWheel()
+
+    def _attachTarget(self, client):
+        client.target = WebSocketClient('ws://127.0.0.1:2375/attach/ws')
+        client.target.ws = AttachSocket(self.upstreamsock)
+
+
+def session(proxy, clientsock, upstreamsock, request):
+    """Open one session and leave it idle, return its ConnectionPair."""
+    proxy.upstreamsock = upstreamsock
+    client = WebSocket(proxy, clientsock, ('127.0.0.1', 0))
+    client._processData(request, proxy)
+    # the handshake response would have been written out by now
+    client._flushSendq()
+    pair = ConnectionPair(client, clientsock.fileno())
+    pair.upstream = Upstream(None, client.target)
+    pair.upstream.pairs.append(pair)
+    pair.timer = proxy.timers.schedule(timers.now() + 30, len)
+    return pair
+
+
+def run(connections, cookie):
+    request = REQUEST % (b'x' * cookie)
+    proxy = NullProxy()
+    # the socket objects are not counted, the proxy cannot shrink them
+    socks = [socket.socketpair() for i in range(connections)]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    pairs = [session(proxy, a, b, request) for a, b in socks]
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    if not all(pair.client.handshaked for pair in pairs):
+        raise RuntimeError('handshake did not complete')
+    for a, b in socks:
+        a.close()
+        b.close()
+    return {
+        'connections': connections,
+        'bytes_per_idle_conn': (after - before) // connections,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--cookie', type=int, default=512,
+                        help='size of the Cookie header')
+    args = parser.parse_args()
+
+    result = run(args.connections, args.cookie)
+    for key in sorted(result):
+        print('%-20s %s' % (key, result[key]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""End to end proxy benchmark
+
+Starts the upstream stand-in (upstream.py) and a WebSocketProxy, each in
+its own process, and drives real client connections through the proxy
+with loadgen.py. Scenarios:
+
+    rampup  connections opened concurrently, handshake p50/p99
+    echo    small messages echoed one at a time, round trip p50/p99
+    bulk    upstream output at several message sizes, MB/s
+    idle    many quiet connections, proxy RSS per connection and the
+            round trip of an active one next to them
+    tls     wss:// connections with full and with resumed TLS handshakes,
+            only with --tls
+
+--tls serves wss:// from the proxy with a throwaway self-signed
+certificate, made by the openssl command, and runs every scenario over it.
+
+Results are printed and written to --output as JSON. With --baseline a
+stored result file is compared metric by metric and the exit status is
+1 when any of them got worse by more than --tolerance.
+
+    python benchmarks/bench_proxy.py --output base.json
+    python benchmarks/bench_proxy.py --baseline base.json
+
+The select engine of the original proxy, from before routes and
+background connects, can be measured too by copying this directory into
+a checkout of it; see results/README.md.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import loadgen  # noqa: E402
+import upstream  # noqa: E402
+from websocketproxy.websocketbase import WebSocket  # noqa: E402
+from websocketproxy.websocketclient import WebSocketClient  # noqa: E402
+from websocketproxy.websocketproxy import WebSocketProxy  # noqa: E402
+
+
+ROUTEID = 'bench'
+SCENARIOS = ('rampup', 'echo', 'bulk', 'idle')
+
+# the original proxy connects upstream inside handleConnected() and has
+# neither routes nor a send queue towards the upstream
+ORIGINAL = not hasattr(WebSocketProxy, '_attachTarget')
+
+
+class BenchProxy(WebSocket):
+    """SimpleProxy from main.py without the printing"""
+
+    __slots__ = ()
+
+    def handleMessage(self):
+        if ORIGINAL:
+            self.target.ws.send(self.data)
+        else:
+            self.target.send(self.data)
+
+    def handleConnected(self):
+        if ORIGINAL:
+            target_url = self.server.routes.get(self.headerid)
+        else:
+            target_url = self.server.routes.resolve(self.headerid)
+        if target_url:
+            self.target = WebSocketClient(host_url=target_url, escape='~',
+                                          close_wait=0.5)
+            if ORIGINAL:
+                self.target.connect()
+
+
+def runUpstream(port):
+    upstream.serve('127.0.0.1', port)
+    while True:
+        time.sleep(3600)
+
+
+def runProxy(port, upstreamPort, engine, relay, certfile):
+    routes = {ROUTEID: 'ws://127.0.0.1:%d/' % upstreamPort}
+    if ORIGINAL:
+        proxy = WebSocketProxy('127.0.0.1', port, BenchProxy)
+        proxy.routes = routes
+        proxy.proxy()
+        return
+
+    kwargs = {'routes': routes}
+    if certfile is not None:
+        from websocketproxy.tls import ServerTLS
+        kwargs['tls'] = ServerTLS(certfile)
+    proxyclass = WebSocketProxy
+    if engine == 'asyncio':
+        from websocketproxy.asyncproxy import AsyncWebSocketProxy
+        proxyclass = AsyncWebSocketProxy
+    elif relay:
+        kwargs['relay'] = True
+    proxyclass('127.0.0.1', port, BenchProxy, **kwargs).proxy()
+
+
+def selfSigned(directory):
+    """Write a certificate and key for 127.0.0.1 into one PEM file."""
+    path = os.path.join(directory, 'proxy.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-days', '1', '-subj', '/CN=127.0.0.1',
+         '-keyout', path, '-out', path + '.crt'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with open(path + '.crt') as src, open(path, 'a') as dst:
+        dst.write(src.read())
+    return path
+
+
+def waitListening(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def rss(pid):
+    """Resident set size of pid in bytes, from /proc."""
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def benchRampup(url, args, proxy):
+    latencies, elapsed = loadgen.rampup(url, ROUTEID, args.rampup,
+                                        args.concurrency)
+    return {
+        'rampup_connects_per_sec': round(len(latencies) / elapsed, 1),
+        'rampup_handshake_p50_ms': ms(loadgen.percentile(latencies, 50)),
+        'rampup_handshake_p99_ms': ms(loadgen.percentile(latencies, 99)),
+    }
+
+
+def benchEcho(url, args, proxy):
+    latencies = loadgen.echo(url, ROUTEID, args.concurrency, args.messages,
+                             args.echo_size)
+    return {
+        'echo_rtt_p50_ms': ms(loadgen.percentile(latencies, 50)),
+        'echo_rtt_p99_ms': ms(loadgen.percentile(latencies, 99)),
+    }
+
+
+def benchBulk(url, args, proxy):
+    result = {}
+    for size in args.bulk_sizes:
+        count = max(1, args.bulk_bytes // size)
+        elapsed = loadgen.bulk(url, ROUTEID, size, count)
+        name = 'bulk_%d_mb_per_sec' % size
+        result[name] = round(size * count / elapsed / 1e6, 2)
+    return result
+
+
+def benchIdle(url, args, proxy):
+    before = rss(proxy.pid)
+    conns = loadgen.idle(url, ROUTEID, args.idle)
+    try:
+        # let the proxy settle before sampling its memory
+        time.sleep(0.5)
+        after = rss(proxy.pid)
+        latencies = loadgen.echo(url, ROUTEID, 1, args.messages,
+                                 args.echo_size)
+    finally:
+        for ws in conns:
+            ws.close()
+    return {
+        'idle_rss_per_conn_bytes': (after - before) // args.idle,
+        'idle_echo_rtt_p99_ms': ms(loadgen.percentile(latencies, 99)),
+    }
+
+
+def benchTLS(url, args, proxy):
+    result = {}
+    runs = [('full', False)]
+    if hasattr(ssl.SSLSocket, 'session'):
+        runs.append(('resumed', True))
+    for name, resume in runs:
+        start = time.time()
+        latencies, resumed = loadgen.tlsUpgrades(
+            '127.0.0.1', args.port, ROUTEID, args.tls_handshakes, resume)
+        elapsed = time.time() - start
+        if resume and resumed < len(latencies) - 1:
+            raise RuntimeError('only %d of %d connections resumed' %
+                               (resumed, len(latencies)))
+        result['tls_%s_connects_per_sec' % name] = round(
+            len(latencies) / elapsed, 1)
+        result['tls_%s_upgrade_p50_ms' % name] = ms(
+            loadgen.percentile(latencies, 50))
+    return result
+
+
+BENCHES = {
+    'rampup': benchRampup,
+    'echo': benchEcho,
+    'bulk': benchBulk,
+    'idle': benchIdle,
+    'tls': benchTLS,
+}
+
+
+def higherIsBetter(name):
+    return name.endswith('_per_sec')
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every shared metric and return the regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline or not baseline[name]:
+            continue
+        old, new = baseline[name], results[name]
+        change = (new - old) / float(old)
+        worse = -change if higherIsBetter(name) else change
+        flag = ''
+        if worse > tolerance:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('%-28s %12s -> %-12s %+6.1f%%%s' %
+              (name, old, new, change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['select', 'asyncio'],
+                        default='select')
+    parser.add_argument('--relay', action='store_true')
+    parser.add_argument('--tls', action='store_true',
+                        help='connect to the proxy with wss://')
+    parser.add_argument('--scenarios',
+                        help='comma separated subset of %s, all of them '
+                             'by default' % ', '.join(sorted(BENCHES)))
+    parser.add_argument('--port', type=int, default=19200,
+                        help='proxy port, the upstream uses the next one')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='client threads for rampup and echo')
+    parser.add_argument('--rampup', type=int, default=500,
+                        help='connections opened by rampup')
+    parser.add_argument('--messages', type=int, default=500,
+                        help='round trips per echo connection')
+    parser.add_argument('--echo-size', type=int, default=32)
+    parser.add_argument('--bulk-sizes', default='1024,16384,262144',
+                        help='comma separated message sizes in bytes')
+    parser.add_argument('--bulk-bytes', type=int, default=64 << 20,
+                        help='bytes flooded per bulk message size')
+    parser.add_argument('--idle', type=int, default=1000,
+                        help='idle connections held open')
+    parser.add_argument('--tls-handshakes', type=int, default=200,
+                        help='connections opened by each tls run')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed relative change before a metric '
+                             'counts as a regression')
+    args = parser.parse_args()
+    args.bulk_sizes = [int(size) for size in args.bulk_sizes.split(',')]
+    if args.scenarios:
+        scenarios = args.scenarios.split(',')
+    else:
+        scenarios = list(SCENARIOS) + (['tls'] if args.tls else [])
+    for scenario in scenarios:
+        if scenario not in BENCHES:
+            parser.error('unknown scenario %r' % scenario)
+    if args.relay and args.engine != 'select':
+        parser.error('--relay needs the select engine')
+    if args.tls and args.engine != 'select':
+        parser.error('--tls needs the select engine')
+    if 'tls' in scenarios and not args.tls:
+        parser.error('the tls scenario needs --tls')
+    if ORIGINAL and (args.engine != 'select' or args.relay or args.tls):
+        parser.error('the original proxy has only the plain select engine')
+
+    certdir = tempfile.mkdtemp()
+    certfile = selfSigned(certdir) if args.tls else None
+    upstreamPort = args.port + 1
+    processes = [
+        multiprocessing.Process(target=runUpstream, args=(upstreamPort,)),
+        multiprocessing.Process(target=runProxy,
+                                args=(args.port, upstreamPort, args.engine,
+                                      args.relay, certfile)),
+    ]
+    for process in processes:
+        process.daemon = True
+        process.start()
+    proxy = processes[1]
+
+    results = {}
+    try:
+        waitListening(upstreamPort)
+        waitListening(args.port)
+        url = '%s://127.0.0.1:%d/' % ('wss' if args.tls else 'ws',
+                                       args.port)
+        for scenario in scenarios:
+            results.update(BENCHES[scenario](url, args, proxy))
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(certdir)
+
+    for key in sorted(results):
+        print('%-28s %s' % (key, results[key]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'engine': args.engine,
+                'relay': args.relay,
+                'tls': args.tls,
+                'python': sys.version.split()[0],
+                'results': results,
+            }, f, indent=2, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print('')
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit('%d metrics regressed: %s' %
+                     (len(regressions), ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
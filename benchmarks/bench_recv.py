@@ -0,0 +1,137 @@
+"""Receive path micro benchmark
+
+Writes masked client frames into a socketpair and reads them with
+WebSocket._handleData the way the proxy loop does, so every read goes
+through the socket, the frame parser and the unmasking. Reports
+throughput and, on Python 3, the bytes allocated per MB received: the
+tracemalloc peak of every read above what was allocated before it,
+summed up. A second, traced pass measures that, tracing is slow.
+
+    python benchmarks/bench_recv.py --frames 20000 --size 4096
+"""
+
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from websocketproxy import exceptions  # noqa: E402
+from websocketproxy.websocketbase import BINARY  # noqa: E402
+from websocketproxy.websocketbase import WebSocket  # noqa: E402
+
+
+class Sink(WebSocket):
+    """Counts the payload bytes of the messages it receives."""
+
+    def handleMessage(self):
+        self.received += len(self.data)
+
+
+def maskedFrame(opcode, payload):
+    """A client frame, built here so the original tree can be measured."""
+    length = len(payload)
+    if length <= 125:
+        header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+    elif length <= 65535:
+        header = struct.pack('!BBH', 0x80 | opcode, 0xFE, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 0xFF, length)
+    mask = bytearray(os.urandom(4))
+    data = bytearray(payload)
+    for i in range(length):
+        data[i] ^= mask[i % 4]
+    return header + bytes(mask) + bytes(data)
+
+
+def feed(sock, frame, frames):
+    try:
+        for i in range(frames):
+            sock.sendall(frame)
+    finally:
+        sock.close()
+
+
+def run(frames, size, trace):
+    left, right = socket.socketpair()
+    client = Sink(None, left, None)
+    client.handshaked = True
+    client.received = 0
+
+    frame = maskedFrame(BINARY, os.urandom(size))
+    writer = threading.Thread(target=feed, args=(right, frame, frames))
+    writer.daemon = True
+
+    reads = 0
+    allocated = 0
+    if trace:
+        tracemalloc.start()
+    start = time.time()
+    writer.start()
+    try:
+        while True:
+            if trace:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            client._handleData(None)
+            if trace:
+                allocated += tracemalloc.get_traced_memory()[1] - before
+            reads += 1
+    except exceptions.RemoteSocketClose:
+        pass
+    elapsed = time.time() - start
+    if trace:
+        tracemalloc.stop()
+    writer.join()
+    left.close()
+
+    if client.received != frames * size:
+        raise RuntimeError('received %d bytes, expected %d' %
+                           (client.received, frames * size))
+    megabytes = frames * len(frame) / 1e6
+    return {
+        'reads': reads,
+        'mb_per_sec': megabytes / elapsed,
+        'alloc_bytes_per_mb': allocated / megabytes if trace else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=4096,
+                        help='payload bytes per frame')
+    parser.add_argument('--output', help='write the result as JSON')
+    args = parser.parse_args()
+
+    result = run(args.frames, args.size, False)
+    if hasattr(tracemalloc, 'reset_peak'):
+        traced = run(args.frames, args.size, True)
+        result['alloc_bytes_per_mb'] = traced['alloc_bytes_per_mb']
+    else:
+        del result['alloc_bytes_per_mb']
+    result['frames'] = args.frames
+    result['size'] = args.size
+    for key in sorted(result):
+        print('%-20s %s' % (key, result[key]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'results': result,
+            }, f, indent=2, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
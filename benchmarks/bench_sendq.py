@@ -0,0 +1,127 @@
+"""Send path micro benchmark
+
+Queues many small frames, as interactive terminal output produces them, on
+a WebSocket over a socketpair and flushes them the way the proxy loop does.
+Reports write syscalls per delivered frame and throughput.
+
+    python benchmarks/bench_sendq.py --frames 100000 --size 32
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from websocketproxy import exceptions  # noqa: E402
+from websocketproxy.websocketbase import WebSocket  # noqa: E402
+
+
+class CountingSocket(object):
+    """Wraps a socket and counts write syscalls."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def send(self, data):
+        self.calls += 1
+        return self.sock.send(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def drain(sock, total):
+    received = 0
+    while received < total:
+        data = sock.recv(1 << 20)
+        if not data:
+            break
+        received += len(data)
+
+
+def flush(client):
+    if hasattr(client, '_flushSendq'):
+        client._flushSendq()
+        return
+    # the original proxy loop, one send() per queued frame
+    while client.sendq:
+        opcode, payload = client.sendq.popleft()
+        remaining = client._sendBuffer(payload)
+        if remaining is not None:
+            client.sendq.appendleft((opcode, remaining))
+            return
+
+
+def run(frames, size, burst):
+    left, right = socket.socketpair()
+    left.setblocking(0)
+    counting = CountingSocket(left)
+    client = WebSocket(None, counting, None)
+
+    payload = os.urandom(size)
+    framesize = len(payload) + (2 if size <= 125 else 4)
+    reader = threading.Thread(target=drain, args=(right, frames * framesize))
+    reader.daemon = True
+    reader.start()
+
+    start = time.time()
+    queued = 0
+    while queued < frames:
+        for i in range(min(burst, frames - queued)):
+            client.sendMessage(payload)
+        queued += burst
+        flush(client)
+    while client.sendq:
+        flush(client)
+    reader.join()
+    elapsed = time.time() - start
+
+    left.close()
+    right.close()
+    return {
+        'frames': frames,
+        'size': size,
+        'burst': burst,
+        'syscalls': counting.calls,
+        'syscalls_per_frame': float(counting.calls) / frames,
+        'frames_per_sec': frames / elapsed,
+        'mb_per_sec': frames * framesize / elapsed / 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=32)
+    parser.add_argument('--burst', type=int, default=64,
+                        help='frames queued between two flushes')
+    parser.add_argument('--output', help='write the result as JSON')
+    args = parser.parse_args()
+
+    try:
+        result = run(args.frames, args.size, args.burst)
+    except exceptions.WebSocketException as e:
+        sys.exit(str(e))
+    for key in sorted(result):
+        print('%-20s %s' % (key, result[key]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'results': result,
+            }, f, indent=2, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Multi-connection load generator for the proxy
+
+Every function opens its own websocket-client connections to the proxy,
+routed by the User-Agent header the way SimpleProxy routes browsers, and
+returns plain numbers so bench_proxy.py can put them into JSON.
+"""
+
+import base64
+import os
+import socket
+import ssl
+import threading
+import time
+
+import websocket
+
+
+# the benchmark proxy uses a self-signed certificate
+SSLOPT = {'cert_reqs': ssl.CERT_NONE, 'check_hostname': False}
+
+UPGRADE = ('GET / HTTP/1.1\r\n'
+           'Host: %s:%d\r\n'
+           'Upgrade: websocket\r\n'
+           'Connection: Upgrade\r\n'
+           'Sec-WebSocket-Key: %s\r\n'
+           'Sec-WebSocket-Version: 13\r\n'
+           'User-Agent: %s\r\n\r\n')
+
+
+def percentile(values, p):
+    """The p-th percentile of values, nearest rank."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def connect(url, routeid, timeout=10):
+    """Open one client connection and return (ws, handshake seconds)."""
+    start = time.time()
+    ws = websocket.create_connection(url, timeout=timeout,
+                                     header=['User-Agent: %s' % routeid],
+                                     sslopt=SSLOPT)
+    return ws, time.time() - start
+
+
+def tlsUpgrades(host, port, routeid, count, resume):
+    """Open count wss:// connections one after the other
+
+    With resume every connection offers the TLS session of the one before
+    it. Returns the seconds each connection took to connect, handshake and
+    upgrade, and how many of them resumed a session.
+    """
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT',
+                                     ssl.PROTOCOL_SSLv23))
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    latencies = []
+    resumed = 0
+    session = None
+    for i in range(count):
+        options = {}
+        if session is not None:
+            options['session'] = session
+        start = time.time()
+        sock = context.wrap_socket(socket.create_connection((host, port)),
+                                   **options)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = UPGRADE % (host, port, key, routeid)
+        sock.sendall(request.encode('ascii'))
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(4096)
+            if not data:
+                raise RuntimeError('connection closed during the upgrade')
+            response += data
+        latencies.append(time.time() - start)
+        if not response.startswith(b'HTTP/1.1 101'):
+            raise RuntimeError('upgrade failed: %r' % response[:40])
+        if getattr(sock, 'session_reused', False):
+            resumed += 1
+        if resume:
+            session = sock.session
+        sock.close()
+    return latencies, resumed
+
+
+def _run(workers, func):
+    """Run func(index) in workers threads and re-raise the first error."""
+    errors = []
+
+    def target(index):
+        try:
+            func(index)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=target, args=(i,))
+               for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def rampup(url, routeid, count, concurrency):
+    """Open count connections, concurrency at a time, like a reconnect storm
+
+    Returns (handshake seconds per connection, elapsed seconds). The
+    connections are closed after all of them are up.
+    """
+    latencies = []
+    conns = []
+    lock = threading.Lock()
+    pending = [count]
+
+    def work(index):
+        while True:
+            with lock:
+                if pending[0] == 0:
+                    return
+                pending[0] -= 1
+            ws, seconds = connect(url, routeid)
+            # the first message proves the attach went through
+            ws.send_binary(b'ping')
+            if ws.recv() != b'ping':
+                raise RuntimeError('echo mismatch')
+            with lock:
+                latencies.append(seconds)
+                conns.append(ws)
+
+    start = time.time()
+    _run(concurrency, work)
+    elapsed = time.time() - start
+    for ws in conns:
+        ws.close()
+    return latencies, elapsed
+
+
+def echo(url, routeid, connections, messages, size):
+    """Round trip times of size byte messages, one at a time per connection
+
+    This is what a user typing into a shell looks like. Returns the round
+    trip seconds of all messages of all connections.
+    """
+    payload = b'k' * size
+    latencies = []
+    lock = threading.Lock()
+
+    def work(index):
+        ws, _ = connect(url, routeid)
+        samples = []
+        try:
+            for i in range(messages):
+                start = time.time()
+                ws.send_binary(payload)
+                if ws.recv() != payload:
+                    raise RuntimeError('echo mismatch')
+                samples.append(time.time() - start)
+        finally:
+            ws.close()
+        with lock:
+            latencies.extend(samples)
+
+    _run(connections, work)
+    return latencies
+
+
+def bulk(url, routeid, size, count):
+    """Have the upstream flood count messages of size bytes
+
+    Returns the seconds from the request until the last message arrived.
+    """
+    ws, _ = connect(url, routeid, timeout=60)
+    try:
+        start = time.time()
+        ws.send('flood %d %d' % (size, count))
+        received = 0
+        while True:
+            opcode, data = ws.recv_data()
+            # the Python 2 proxy forwards the text marker as Binary
+            if data == b'done':
+                break
+            if len(data) != size:
+                raise RuntimeError('got %d bytes, expected %d' %
+                                   (len(data), size))
+            received += 1
+        elapsed = time.time() - start
+    finally:
+        ws.close()
+    if received != count:
+        raise RuntimeError('got %d messages, expected %d' %
+                           (received, count))
+    return elapsed
+
+
+def idle(url, routeid, count):
+    """Open count connections that stay quiet; the caller closes them."""
+    conns = []
+    for i in range(count):
+        ws, _ = connect(url, routeid)
+        conns.append(ws)
+    # make sure every attach is up before anything is measured
+    for ws in conns:
+        ws.send_binary(b'up')
+    for ws in conns:
+        if ws.recv() != b'up':
+            raise RuntimeError('echo mismatch')
+    return conns
@@ -0,0 +1,144 @@
+"""Local stand-in for the Docker attach endpoint
+
+A minimal websocket server, one thread per connection, that echoes every
+message back. A text message "flood <size> <count>" makes it send count
+binary messages of size bytes instead, followed by the text message
+"done", the way a container printing a big file does.
+
+    python benchmarks/upstream.py --port 19100
+"""
+
+import argparse
+import base64
+import hashlib
+import socket
+import struct
+import threading
+
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+RESPONSE = (b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Upgrade: websocket\r\n'
+            b'Connection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: %s\r\n\r\n')
+
+
+class Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError()
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def handshake(self):
+        while b'\r\n\r\n' not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError()
+            self.buffer += data
+        header, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+
+        key = None
+        for line in header.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'sec-websocket-key':
+                key = value.strip()
+        accept = base64.b64encode(hashlib.sha1(key + GUID).digest())
+        self.sock.sendall(RESPONSE % accept)
+
+    def readMessage(self):
+        """Return (opcode, payload) of the next frame."""
+        b1, b2 = struct.unpack('!BB', self.read(2))
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read(8))[0]
+        mask = bytearray(self.read(4)) if b2 & 0x80 else None
+        payload = bytearray(self.read(length))
+        if mask is not None:
+            for i in range(length):
+                payload[i] ^= mask[i % 4]
+        return b1 & 0x0F, bytes(payload)
+
+    def frame(self, opcode, payload):
+        length = len(payload)
+        if length <= 125:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length <= 65535:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        return header + payload
+
+    def flood(self, size, count):
+        frame = self.frame(0x2, b'x' * size)
+        # write in batches of about 1 MiB to keep syscalls out of the way
+        batch = max(1, (1 << 20) // len(frame))
+        while count > 0:
+            n = min(batch, count)
+            self.sock.sendall(frame * n)
+            count -= n
+        self.sock.sendall(self.frame(0x1, b'done'))
+
+    def serve(self):
+        try:
+            self.handshake()
+            while True:
+                opcode, payload = self.readMessage()
+                if opcode == 0x8:
+                    self.sock.sendall(self.frame(0x8, payload[:2]))
+                    return
+                if opcode in (0x9, 0xA):
+                    continue
+                if opcode == 0x1 and payload.startswith(b'flood '):
+                    size, count = payload.split()[1:3]
+                    self.flood(int(size), int(count))
+                else:
+                    self.sock.sendall(self.frame(opcode, payload))
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.sock.close()
+
+
+def serve(host, port):
+    """Listen on host:port and serve connections from a daemon thread."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+
+    def accept():
+        while True:
+            sock, address = listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=Connection(sock).serve)
+            thread.daemon = True
+            thread.start()
+
+    thread = threading.Thread(target=accept)
+    thread.daemon = True
+    thread.start()
+    return listener
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=19100)
+    args = parser.parse_args()
+    serve(args.host, args.port)
+    threading.Event().wait(1e9)
+
+
+if __name__ == '__main__':
+    main()
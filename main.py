@@ -1,36 +1,129 @@
+import argparse
+import ssl
 import termios
 import sys
 import logging
 
-from websocketproxy.websocketclient import WebSocketClient
-from websocketproxy.websocketbase import WebSocket
+from websocketproxy.websocketclient import UpstreamPool, WebSocketClient
+from websocketproxy.websocketbase import DeflateOptions, WebSocket
 from websocketproxy.websocketproxy import WebSocketProxy
+from websocketproxy.routes import createResolver
+from websocketproxy.supervisor import Supervisor
+from websocketproxy.tls import ServerTLS
 
 LOG = logging.getLogger('websocket-proxy')
 
+# routes used when no --routes file is given
 target_list = {"579484fa-1f8b-4b0a-9579-8e988ba46cf0":"ws://kevin-mint:2375/v1.22/containers/f9b69ee2c2fdc6526e783306d185db1e5995cd714ed2ff10060d3e4fba96a27b/attach/ws?logs=0&stream=1&stdin=1&stdout=1&stderr=1",
                "9ea692b0-8937-4d16-b021-5b0f92ebd1bd":"ws://kevin-mint:2375/v1.22/containers/cee85845f2fcd151885fecc367dcb67df4f049baa20a3472de19ff2785709571/attach/ws?logs=0&stream=1&stdin=1&stdout=1&stderr=1"}
 
+# cached DNS and a spare TCP connection per docker host
+pool = UpstreamPool(dns_ttl=30, spare=1)
+
 clients = []
 class SimpleProxy(WebSocket):
+    # no per-session __dict__, WebSocket declares every attribute
+    __slots__ = ()
+
     def handleMessage(self):
-        self.target.ws.send(self.data)
+        self.target.send(self.data)
 
     def handleConnected(self):
        print(self.address, 'connected')
-       target_url = target_list.get(self.headerid, None)
+       target_url = self.server.routes.resolve(self.headerid)
        if target_url:
            escape = "~"
            close_wait = 0.5
-           wscls = WebSocketClient(host_url=target_url, escape=escape, close_wait=close_wait)
-           wscls.connect()
-           self.target = wscls
+           # connected in the background by the proxy loop
+           self.target = WebSocketClient(host_url=target_url, escape=escape,
+                                         close_wait=close_wait, pool=pool)
 
     def handleClose(self):
        print(self.address, 'closed')
 
 def main():
-    server = WebSocketProxy('', 13256, SimpleProxy)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['select', 'asyncio'],
+                        default='select',
+                        help='select: WebSocketProxy event loop, '
+                             'asyncio: AsyncWebSocketProxy (Python 3)')
+    parser.add_argument('--relay', action='store_true',
+                        help='forward frames without decoding messages '
+                             '(select engine only)')
+    parser.add_argument('--share', choices=['all', 'first', 'none'],
+                        help='one attach per container for all its viewers, '
+                             'and which of them may type (select engine '
+                             'only)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of SO_REUSEPORT worker processes, '
+                             '0 runs the proxy in this process')
+    parser.add_argument('--routes', metavar='FILE',
+                        help='JSON file mapping route IDs to attach URLs, '
+                             'reloaded when it changes')
+    parser.add_argument('--warm', action='store_true',
+                        help='keep an attach socket ready for every known '
+                             'target (single process only)')
+    parser.add_argument('--deflate', action='store_true',
+                        help='offer permessage-deflate, which costs about '
+                             '290 KiB of zlib state per session using it '
+                             '(not with --relay)')
+    parser.add_argument('--certfile',
+                        help='PEM certificate chain to serve wss:// with '
+                             '(select engine only)')
+    parser.add_argument('--keyfile',
+                        help='private key of --certfile if it is not in it')
+    parser.add_argument('--upstream-cafile',
+                        help='CA bundle to verify wss:// attach endpoints '
+                             'with, e.g. the one of the docker daemon')
+    parser.add_argument('--upstream-certfile',
+                        help='client certificate for wss:// attach '
+                             'endpoints')
+    parser.add_argument('--upstream-keyfile',
+                        help='private key of --upstream-certfile if it is '
+                             'not in it')
+    args = parser.parse_args()
+    if args.engine == 'asyncio':
+        for option in ('certfile', 'relay', 'share'):
+            if getattr(args, option):
+                parser.error('--%s needs the select engine' % option)
+    if args.warm and args.workers > 0:
+        parser.error('--warm cannot be combined with --workers')
+    if args.share and args.relay:
+        parser.error('--share cannot be combined with --relay')
+    if args.deflate and args.relay:
+        parser.error('--deflate cannot be combined with --relay')
+    if args.upstream_cafile or args.upstream_certfile:
+        context = ssl.create_default_context(cafile=args.upstream_cafile)
+        if args.upstream_certfile:
+            context.load_cert_chain(args.upstream_certfile,
+                                    args.upstream_keyfile)
+        pool.ssl_context = context
+    routes = createResolver(args.routes or target_list)
+    if args.warm:
+        for target_url in routes.urls():
+            pool.warm(target_url)
+
+    proxyclass = WebSocketProxy
+    kwargs = {'routes': routes}
+    if args.engine == 'asyncio':
+        from websocketproxy.asyncproxy import AsyncWebSocketProxy
+        proxyclass = AsyncWebSocketProxy
+    if args.relay:
+        kwargs['relay'] = True
+    if args.share:
+        kwargs['shareUpstreams'] = True
+        kwargs['stdinPolicy'] = args.share
+    if args.deflate:
+        kwargs['deflate'] = DeflateOptions()
+    if args.certfile:
+        # created before the workers fork so they share the ticket key
+        kwargs['tls'] = ServerTLS(args.certfile, args.keyfile)
+
+    if args.workers > 0:
+        server = Supervisor('', 13256, SimpleProxy, workers=args.workers,
+                            proxyclass=proxyclass, **kwargs)
+    else:
+        server = proxyclass('', 13256, SimpleProxy, **kwargs)
     server.proxy()
 
 if __name__ == '__main__':
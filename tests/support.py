@@ -0,0 +1,186 @@
+"""A scriptable upstream and a proxy running in a thread, for the tests"""
+
+import base64
+import hashlib
+import socket
+import struct
+import threading
+
+import websocket
+
+from websocketproxy.websocketbase import WebSocket
+from websocketproxy.websocketclient import WebSocketClient
+from websocketproxy.websocketproxy import WebSocketProxy
+
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+ROUTEID = 'test'
+
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+
+
+class UpstreamConnection(object):
+    """The server side of one attach socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError()
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def handshake(self):
+        while b'\r\n\r\n' not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError()
+            self.buffer += data
+        header, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        key = None
+        for line in header.split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'sec-websocket-key':
+                key = value.strip()
+        accept = base64.b64encode(hashlib.sha1(key + GUID).digest())
+        self.sock.sendall(b'HTTP/1.1 101 Switching Protocols\r\n'
+                          b'Upgrade: websocket\r\n'
+                          b'Connection: Upgrade\r\n'
+                          b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+    def readFrame(self):
+        """Return (fin, opcode, payload) of the next frame."""
+        b1, b2 = struct.unpack('!BB', self.read(2))
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read(8))[0]
+        mask = bytearray(self.read(4)) if b2 & 0x80 else None
+        payload = bytearray(self.read(length))
+        if mask is not None:
+            for i in range(length):
+                payload[i] ^= mask[i % 4]
+        return b1 & 0x80, b1 & 0x0F, bytes(payload)
+
+
+def frame(opcode, payload, fin=True, mask=None):
+    """A frame the way the upstream sends them, or masked by a client."""
+    b1 = opcode | (0x80 if fin else 0)
+    b2 = 0x80 if mask is not None else 0
+    length = len(payload)
+    if length <= 125:
+        header = struct.pack('!BB', b1, b2 | length)
+    elif length <= 65535:
+        header = struct.pack('!BBH', b1, b2 | 126, length)
+    else:
+        header = struct.pack('!BBQ', b1, b2 | 127, length)
+    if mask is None:
+        return header + payload
+    return header + mask + xor(payload, mask)
+
+
+def xor(data, mask, offset=0):
+    """XOR byte by byte, what websocketbase._unmask() has to match."""
+    mask = bytearray(mask)
+    result = bytearray(data)
+    for i in range(len(result)):
+        result[i] ^= mask[(offset + i) % 4]
+    return bytes(result)
+
+
+class FakeUpstream(object):
+    """Listens on a free port and runs handler(connection) per attach."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.url = 'ws://127.0.0.1:%d/' % self.listener.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, sock):
+        connection = UpstreamConnection(sock)
+        try:
+            connection.handshake()
+            self.handler(connection)
+        except (EOFError, socket.error):
+            pass
+        finally:
+            sock.close()
+
+    def close(self):
+        self.listener.close()
+
+
+class EchoSession(WebSocket):
+    """Routes every client to the upstream of its User-Agent."""
+
+    def handleMessage(self):
+        self.target.send(self.data)
+
+    def handleConnected(self):
+        self.target = WebSocketClient(
+            self.server.routes.resolve(self.headerid), close_wait=0.5)
+
+
+class ProxyThread(object):
+    """A WebSocketProxy looping in a daemon thread
+
+    error is whatever made proxy() return, if anything did.
+    """
+
+    def __init__(self, upstreamUrl, **kwargs):
+        kwargs.setdefault('routes', {ROUTEID: upstreamUrl})
+        self.proxy = WebSocketProxy('127.0.0.1', 0, EchoSession, **kwargs)
+        self.port = self.proxy.serversocket.getsockname()[1]
+        self.url = 'ws://127.0.0.1:%d/' % self.port
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.proxy.proxy()
+        except Exception as e:
+            self.error = e
+
+    def connect(self, timeout=5):
+        return websocket.create_connection(
+            self.url, timeout=timeout, header=['User-Agent: %s' % ROUTEID])
+
+
+class FakeClock(object):
+    """A clock that only moves when the test advances it."""
+
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
@@ -0,0 +1,73 @@
+import threading
+import time
+import unittest
+
+import websocket
+
+from tests import support
+
+try:
+    from websocketproxy.asyncproxy import AsyncWebSocketProxy
+except SyntaxError:
+    # async def, Python 3 only
+    AsyncWebSocketProxy = None
+
+
+@unittest.skipIf(AsyncWebSocketProxy is None, 'needs Python 3')
+class StalledUpstreamTest(unittest.TestCase):
+    def setUp(self):
+        self.stalled = []
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.upstream = support.FakeUpstream(self.handler)
+        self.addCleanup(self.upstream.close)
+
+        self.proxy = AsyncWebSocketProxy(
+            '127.0.0.1', 0, support.EchoSession,
+            routes={support.ROUTEID: self.upstream.url})
+        thread = threading.Thread(target=self.proxy.proxy)
+        thread.daemon = True
+        thread.start()
+        while self.proxy.server is None or not self.proxy.server.sockets:
+            time.sleep(0.01)
+        port = self.proxy.server.sockets[0].getsockname()[1]
+        self.url = 'ws://127.0.0.1:%d/' % port
+
+    def handler(self, connection):
+        connection.readFrame()
+        if not self.stalled:
+            self.stalled.append(connection)
+            stream = (support.frame(support.TEXT, b'first') +
+                      support.frame(support.TEXT, b'second') +
+                      support.frame(support.BINARY, b'z' * 1000))
+            connection.sock.sendall(stream[:40])
+            self.release.wait(10)
+            connection.sock.sendall(stream[40:])
+        else:
+            connection.sock.sendall(support.frame(support.TEXT, b'ok'))
+        connection.readFrame()
+
+    def connect(self):
+        return websocket.create_connection(
+            self.url, timeout=5,
+            header=['User-Agent: %s' % support.ROUTEID])
+
+    def test_other_sessions_keep_running(self):
+        first = self.connect()
+        first.send_binary(b'go')
+        # both arrived with one read
+        self.assertEqual(first.recv(), 'first')
+        self.assertEqual(first.recv(), 'second')
+
+        second = self.connect()
+        second.send_binary(b'go')
+        self.assertEqual(second.recv(), 'ok')
+        second.close()
+
+        self.release.set()
+        self.assertEqual(first.recv(), b'z' * 1000)
+        first.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
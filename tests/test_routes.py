@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests import support
+from websocketproxy import routes
+
+
+class CachedRoutesTest(unittest.TestCase):
+    def setUp(self):
+        self.table = {'a': 'ws://a/', 'b': 'ws://b/', 'c': 'ws://c/'}
+        self.lookups = []
+        self.clock = support.FakeClock()
+        self.routes = routes.CachedRoutes(self.lookup, ttl=60, negativeTTL=5,
+                                          size=2, clock=self.clock)
+
+    def lookup(self, routeid):
+        self.lookups.append(routeid)
+        return self.table.get(routeid)
+
+    def test_ttl(self):
+        self.assertEqual(self.routes.resolve('a'), 'ws://a/')
+        self.table['a'] = 'ws://moved/'
+        self.clock.advance(59)
+        self.assertEqual(self.routes.resolve('a'), 'ws://a/')
+        self.clock.advance(1)
+        self.assertEqual(self.routes.resolve('a'), 'ws://moved/')
+        self.assertEqual(self.lookups, ['a', 'a'])
+
+    def test_negative_ttl(self):
+        self.assertIsNone(self.routes.resolve('new'))
+        self.table['new'] = 'ws://new/'
+        self.clock.advance(4)
+        self.assertIsNone(self.routes.resolve('new'))
+        self.clock.advance(1)
+        self.assertEqual(self.routes.resolve('new'), 'ws://new/')
+        self.assertEqual(self.lookups, ['new', 'new'])
+
+    def test_lru_eviction(self):
+        self.routes.resolve('a')
+        self.routes.resolve('b')
+        # a is now the most recently used, so c evicts b
+        self.routes.resolve('a')
+        self.routes.resolve('c')
+        self.assertEqual(list(self.routes.cache), ['a', 'c'])
+        self.routes.resolve('a')
+        self.routes.resolve('b')
+        self.assertEqual(self.lookups, ['a', 'b', 'c', 'b'])
+
+    def test_invalidate(self):
+        self.routes.resolve('a')
+        self.routes.resolve('b')
+        self.routes.invalidate('a')
+        self.assertEqual(list(self.routes.cache), ['b'])
+        self.routes.invalidate()
+        self.assertEqual(len(self.routes.cache), 0)
+
+
+class FileRoutesTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'routes.json')
+        self.mtime = 1000000
+        self.write({'a': 'ws://a/'})
+        self.clock = support.FakeClock()
+        self.routes = routes.FileRoutes(self.path, interval=1.0,
+                                        clock=self.clock)
+
+    def write(self, table):
+        with open(self.path, 'w') as f:
+            f.write(table if isinstance(table, str) else json.dumps(table))
+        # a new mtime even when the test runs within one clock tick
+        self.mtime += 10
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    def test_reload_on_change(self):
+        self.assertEqual(self.routes.resolve('a'), 'ws://a/')
+        self.write({'a': 'ws://moved/', 'b': 'ws://b/'})
+        # not checked again within the interval
+        self.clock.advance(0.5)
+        self.assertEqual(self.routes.resolve('a'), 'ws://a/')
+        self.clock.advance(0.5)
+        self.assertEqual(self.routes.resolve('a'), 'ws://moved/')
+        self.assertEqual(sorted(self.routes.urls()),
+                         ['ws://b/', 'ws://moved/'])
+
+    def test_broken_file_keeps_the_last_good_table(self):
+        self.routes.resolve('a')
+        for broken in ('{"a": ', '["ws://a/"]', '{"a": 1}'):
+            self.write(broken)
+            self.clock.advance(1)
+            self.assertEqual(self.routes.resolve('a'), 'ws://a/')
+
+        os.remove(self.path)
+        self.clock.advance(1)
+        self.assertEqual(self.routes.resolve('a'), 'ws://a/')
+
+        self.write({'a': 'ws://fixed/'})
+        self.clock.advance(1)
+        self.assertEqual(self.routes.resolve('a'), 'ws://fixed/')
+
+    def test_broken_file_at_startup(self):
+        self.write('{')
+        self.assertRaises(ValueError, routes.FileRoutes, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
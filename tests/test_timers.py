@@ -0,0 +1,103 @@
+import unittest
+
+from tests import support
+from websocketproxy.timers import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = support.FakeClock()
+        self.wheel = TimerWheel(tick=1.0, slots=8, clock=self.clock)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((name, self.clock()))
+
+    def elapse(self, seconds):
+        # advance one tick at a time like the proxy loop would
+        for i in range(int(seconds)):
+            self.clock.advance(1)
+            self.wheel.expire(self.clock())
+
+    def test_schedule(self):
+        self.wheel.schedule(self.clock() + 2.5, self.fire, 'a')
+        self.elapse(2)
+        self.assertEqual(self.fired, [])
+        # rounded up to the next tick
+        self.elapse(1)
+        self.assertEqual(self.fired, [('a', 1003.0)])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_reschedule(self):
+        timer = self.wheel.schedule(self.clock() + 2, self.fire, 'a')
+        self.wheel.reschedule(timer, self.clock() + 5)
+        self.elapse(4)
+        self.assertEqual(self.fired, [])
+        self.wheel.reschedule(timer, self.clock() + 1)
+        self.elapse(1)
+        self.assertEqual(self.fired, [('a', 1005.0)])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_reschedule_from_the_callback(self):
+        def again(name):
+            self.fire(name)
+            if len(self.fired) < 3:
+                self.wheel.reschedule(timer, self.clock() + 2)
+
+        timer = self.wheel.schedule(self.clock() + 2, again, 'a')
+        self.elapse(10)
+        self.assertEqual(self.fired, [('a', 1002.0), ('a', 1004.0),
+                                      ('a', 1006.0)])
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(self.clock() + 2, self.fire, 'a')
+        self.wheel.schedule(self.clock() + 2, self.fire, 'b')
+        self.wheel.cancel(timer)
+        # cancelling twice is harmless
+        self.wheel.cancel(timer)
+        self.assertEqual(self.wheel.count, 1)
+        self.elapse(3)
+        self.assertEqual(self.fired, [('b', 1002.0)])
+
+    def test_expiry_across_wrap(self):
+        # 20 ticks ahead shares a slot with ticks 4 and 12 of an 8 slot
+        # wheel
+        self.wheel.schedule(self.clock() + 20, self.fire, 'late')
+        self.wheel.schedule(self.clock() + 4, self.fire, 'early')
+        self.elapse(19)
+        self.assertEqual(self.fired, [('early', 1004.0)])
+        self.elapse(1)
+        self.assertEqual(self.fired, [('early', 1004.0), ('late', 1020.0)])
+
+    def test_long_stall(self):
+        for delay in (1, 5, 9, 30):
+            self.wheel.schedule(self.clock() + delay, self.fire, delay)
+        self.clock.advance(100)
+        self.wheel.expire(self.clock())
+        self.assertEqual(sorted(name for name, when in self.fired),
+                         [1, 5, 9, 30])
+        self.assertEqual(self.wheel.count, 0)
+
+    def test_next_deadline(self):
+        self.assertIsNone(self.wheel.nextDeadline())
+        timer = self.wheel.schedule(self.clock() + 3.2, self.fire, 'a')
+        self.wheel.schedule(self.clock() + 6, self.fire, 'b')
+        self.assertEqual(self.wheel.nextDeadline(), 1004.0)
+        self.wheel.cancel(timer)
+        self.assertEqual(self.wheel.nextDeadline(), 1006.0)
+        self.elapse(6)
+        self.assertIsNone(self.wheel.nextDeadline())
+
+    def test_next_deadline_of_a_later_turn(self):
+        # may be early by whole turns, never late
+        self.wheel.schedule(self.clock() + 12, self.fire, 'a')
+        deadline = self.wheel.nextDeadline()
+        self.assertLessEqual(deadline, 1012.0)
+        self.clock.now = deadline
+        self.wheel.expire(deadline)
+        self.assertEqual(self.fired, [])
+        self.assertEqual(self.wheel.nextDeadline(), 1012.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
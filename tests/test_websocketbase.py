@@ -0,0 +1,475 @@
+import os
+import socket
+import threading
+import unittest
+import zlib
+
+from tests import support
+from websocketproxy import exceptions
+from websocketproxy import websocketbase
+from websocketproxy.websocketbase import WebSocket
+
+
+MASK = b'\x37\xfa\x21\x3d'
+
+
+def drain(sock, total, received):
+    while len(received) < total:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received.extend(data)
+
+
+class FlushSendqTest(unittest.TestCase):
+    def test_entry_with_more_buffers_than_iov_max(self):
+        # one relayed upstream read of tiny frames is one sendq entry
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        left.setblocking(0)
+        client = WebSocket(None, left, None)
+        buffers = [b'\x82\x01', b'x'] * (websocketbase.IOV_MAX * 5)
+        client._appendFrame(websocketbase.STREAM, tuple(buffers))
+
+        expected = b''.join(buffers)
+        received = bytearray()
+        reader = threading.Thread(target=drain,
+                                  args=(right, len(expected), received))
+        reader.daemon = True
+        reader.start()
+        while client.sendq:
+            client._flushSendq()
+        reader.join(10)
+        self.assertEqual(bytes(received), expected)
+        self.assertEqual(client.sendqbytes, 0)
+
+
+class SendRecorder(object):
+    """A socket without sendmsg that takes at most limit bytes a call."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.calls = []
+        self.received = bytearray()
+
+    def send(self, data):
+        self.calls.append(data)
+        sent = min(len(data), self.limit)
+        self.received.extend(memoryview(data)[:sent].tobytes())
+        return sent
+
+
+class FlushWithoutSendmsgTest(unittest.TestCase):
+    def flush(self, buffers, limit):
+        sock = SendRecorder(limit)
+        client = WebSocket(None, sock, None)
+        # SSL sockets, and every socket on Python 2, have no sendmsg()
+        client.usingssl = True
+        for frame in buffers:
+            client._appendFrame(websocketbase.BINARY, frame)
+        while client.sendq:
+            client._flushSendq()
+        expected = b''.join([b''.join(frame) for frame in buffers])
+        self.assertEqual(bytes(sock.received), expected)
+        return sock.calls
+
+    def test_large_payload_is_not_copied(self):
+        payload = b'p' * (websocketbase.SENDBUDGET * 8)
+        calls = self.flush([(b'\x82\x7f' + b'\0' * 8, payload)], 1 << 20)
+        for data in calls:
+            self.assertTrue(isinstance(data, memoryview) or
+                            len(data) <= websocketbase.SENDBUDGET)
+        # the payload goes out from the queued buffer itself
+        self.assertTrue(all(isinstance(data, memoryview)
+                            for data in calls[1:]))
+
+    def test_small_buffers_are_joined_within_budget(self):
+        frames = [(b'\x82\x7e\x10\x00', b's' * 4096)] * 200
+        calls = self.flush(frames, 1 << 20)
+        self.assertLess(len(calls), 10)
+        for data in calls:
+            self.assertLessEqual(len(data), websocketbase.SENDBUDGET)
+
+
+class UnmaskTest(unittest.TestCase):
+    def test_matches_bytewise_xor(self):
+        mask = bytearray(MASK)
+        for length in (0, 1, 3, 4, 5, 125, 126, 65537):
+            data = os.urandom(length)
+            for offset in range(6):
+                self.assertEqual(
+                    websocketbase._unmask(data, mask, offset),
+                    support.xor(data, mask, offset),
+                    'length %d offset %d' % (length, offset))
+
+    def test_memoryview(self):
+        data = os.urandom(130)
+        view = memoryview(data)[3:]
+        self.assertEqual(websocketbase._unmask(view, bytearray(MASK), 7),
+                         support.xor(data[3:], MASK, 7))
+
+
+class Recorder(WebSocket):
+    """Keeps the messages the parser delivers."""
+
+    def handleMessage(self):
+        if isinstance(self.data, bytearray):
+            self.messages.append(bytes(self.data))
+        else:
+            self.messages.append(self.data)
+
+
+
+class ParseMessageTest(unittest.TestCase):
+    """Frames must decode the same however the reads split them"""
+
+    SMALL = (support.frame(support.TEXT, u'h\xe9llo'.encode('utf-8'),
+                           mask=MASK) +
+             support.frame(support.BINARY, b'a' * 125) +
+             support.frame(support.BINARY, b'b' * 126, mask=MASK) +
+             support.frame(support.TEXT, b'fra', fin=False, mask=MASK) +
+             support.frame(support.PING, b'beat', mask=MASK) +
+             support.frame(0x0, b'gm', fin=False) +
+             support.frame(0x0, b'ent', mask=MASK) +
+             support.frame(support.BINARY, b'', mask=MASK) +
+             support.frame(support.CLOSE, b'\x03\xe8bye', mask=MASK))
+
+    def parse(self, chunks, maxpayload=None):
+        client = Recorder(None, None, None)
+        client.handshaked = True
+        client.messages = []
+        if maxpayload is not None:
+            client.maxpayload = maxpayload
+        error = None
+        try:
+            for chunk in chunks:
+                client._parseMessage(chunk)
+        except exceptions.WebSocketException as e:
+            error = type(e)
+        sent = b''.join([b''.join([bytes(buff) for buff in frame])
+                         for opcode, frame in client.sendq or ()])
+        return client.messages, sent, client.closed, error
+
+    def assertSplitsMatch(self, stream, offsets, **kwargs):
+        expected = self.parse([stream], **kwargs)
+        for offset in offsets:
+            # no diff of 64 KiB payloads when they differ
+            if self.parse([stream[:offset], stream[offset:]],
+                          **kwargs) != expected:
+                self.fail('split at %d decodes differently' % offset)
+        return expected
+
+    def test_every_split(self):
+        messages, sent, closed, error = self.assertSplitsMatch(
+            self.SMALL, range(len(self.SMALL) + 1))
+        self.assertEqual(messages, [u'h\xe9llo', b'a' * 125, b'b' * 126,
+                                    u'fragment', b''])
+        # the PONG, then the Close echoed back
+        self.assertEqual(sent, b'\x8a\x04beat\x88\x05\x03\xe8bye')
+        self.assertTrue(closed)
+        self.assertIsNone(error)
+
+    def test_byte_by_byte(self):
+        stream = self.SMALL
+        chunks = [stream[i:i + 1] for i in range(len(stream))]
+        self.assertEqual(self.parse(chunks), self.parse([stream]))
+
+    def test_64_bit_length(self):
+        payload = os.urandom(65536)
+        stream = (support.frame(support.BINARY, b'x', mask=MASK) +
+                  support.frame(support.BINARY, payload, mask=MASK) +
+                  support.frame(support.BINARY, payload) +
+                  support.frame(support.TEXT, b'end', mask=MASK))
+        size = len(stream)
+        # every offset around the headers, some inside the payloads
+        offsets = (list(range(0, 32)) + list(range(32, size - 32, 997)) +
+                   list(range(65550, 65600)) + list(range(size - 32, size)))
+        messages, sent, closed, error = self.assertSplitsMatch(stream,
+                                                               offsets)
+        self.assertEqual(messages, [b'x', payload, payload, u'end'])
+
+    def test_maxpayload(self):
+        stream = (support.frame(support.BINARY, b'ok', mask=MASK) +
+                  support.frame(support.BINARY, b'y' * 1000, mask=MASK))
+        messages, sent, closed, error = self.assertSplitsMatch(
+            stream, range(len(stream) + 1), maxpayload=1000)
+        self.assertEqual(messages, [b'ok'])
+        self.assertEqual(error, exceptions.ExcceedSize)
+
+
+class FrameRelayTest(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+        self.relay = websocketbase.FrameRelay(self.output, self.control)
+
+    def output(self, buffers):
+        self.written.append(b''.join([b.tobytes() for b in buffers]))
+
+    def control(self, opcode, payload):
+        pass
+
+    def queue(self, name):
+        self.written.append(name)
+
+    def test_messages_wait_for_the_last_fragment(self):
+        self.relay.feed(b'\x02\x03abc')
+        # control frames may go between fragments
+        self.relay.deferControl(self.queue, 'ping')
+        self.relay.defer(self.queue, 'broadcast')
+        self.relay.feed(b'\x00\x02de\x80')
+        # and keep their place behind held messages
+        self.relay.deferControl(self.queue, 'close')
+        self.relay.feed(b'\x01f')
+        self.assertEqual(self.written, [b'\x02\x03abc', 'ping',
+                                        b'\x00\x02de', b'\x80\x01f',
+                                        'broadcast', 'close'])
+
+    def test_control_frames_wait_for_the_frame(self):
+        self.relay.feed(b'\x82\x03a')
+        self.relay.deferControl(self.queue, 'ping')
+        self.relay.feed(b'bc')
+        self.assertEqual(self.written, [b'\x82\x03a', b'bc', 'ping'])
+        self.relay.defer(self.queue, 'broadcast')
+        self.assertEqual(self.written[-1], 'broadcast')
+
+
+class NullProxy(object):
+    def _attachTarget(self, client):
+        pass
+
+
+class DeflateDefaultTest(unittest.TestCase):
+    REQUEST = (b'GET / HTTP/1.1\r\n'
+               b'Host: 127.0.0.1\r\n'
+               b'Upgrade: websocket\r\n'
+               b'Connection: Upgrade\r\n'
+               b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+               b'Sec-WebSocket-Version: 13\r\n'
+               b'Sec-WebSocket-Extensions: permessage-deflate; '
+               b'client_max_window_bits\r\n'
+               b'User-Agent: test\r\n\r\n')
+
+    def handshake(self, options):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        client = WebSocket(None, left, None)
+        if options is not None:
+            client.deflateOptions = options
+        client._processData(self.REQUEST, NullProxy())
+        opcode, (response,) = client.sendq[0]
+        return client, response
+
+    def test_off_by_default(self):
+        client, response = self.handshake(None)
+        self.assertIsNone(client.deflate)
+        self.assertNotIn(b'Sec-WebSocket-Extensions', response)
+
+    def test_opt_in(self):
+        client, response = self.handshake(websocketbase.DeflateOptions())
+        self.assertIsNotNone(client.deflate)
+        self.assertIn(b'Sec-WebSocket-Extensions: permessage-deflate',
+                      response)
+
+
+def deflate(data, windowBits=15):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -windowBits)
+    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]
+
+
+class DeflateNegotiationTest(unittest.TestCase):
+    def negotiate(self, offers, **kwargs):
+        return websocketbase.DeflateOptions(**kwargs).negotiate(offers)[1]
+
+    def test_offers(self):
+        self.assertEqual(
+            self.negotiate('x-webkit-deflate-frame, permessage-deflate; '
+                           'client_max_window_bits'),
+            'permessage-deflate; client_max_window_bits=15')
+        # the first offer has a parameter the server does not know
+        self.assertEqual(
+            self.negotiate('permessage-deflate; foo, permessage-deflate'),
+            'permessage-deflate')
+        self.assertEqual(self.negotiate('x-webkit-deflate-frame'), None)
+
+    def test_window_bits(self):
+        self.assertEqual(
+            self.negotiate('permessage-deflate; server_max_window_bits=15'),
+            'permessage-deflate; server_max_window_bits=15')
+        self.assertEqual(
+            self.negotiate('permessage-deflate; server_max_window_bits=10'),
+            'permessage-deflate; server_max_window_bits=10')
+        self.assertEqual(
+            self.negotiate('permessage-deflate', windowBits=12),
+            'permessage-deflate; server_max_window_bits=12')
+        self.assertEqual(
+            self.negotiate('permessage-deflate; '
+                           'client_max_window_bits="10"'),
+            'permessage-deflate; client_max_window_bits=10')
+
+    def test_invalid_parameters(self):
+        for offer in ('server_max_window_bits=8',
+                      'server_max_window_bits=16',
+                      'server_max_window_bits=010',
+                      'server_max_window_bits=abc',
+                      'server_max_window_bits',
+                      'client_max_window_bits=7',
+                      'server_no_context_takeover=1',
+                      'server_no_context_takeover; '
+                      'server_no_context_takeover',
+                      'unknown'):
+            self.assertEqual(
+                self.negotiate('permessage-deflate; ' + offer), None,
+                offer)
+
+    def test_client_window_needs_the_offer(self):
+        # the client may only be held to a smaller window it offered
+        self.assertEqual(
+            self.negotiate('permessage-deflate', clientWindowBits=10), None)
+        self.assertEqual(
+            self.negotiate('permessage-deflate; client_max_window_bits',
+                           clientWindowBits=10),
+            'permessage-deflate; client_max_window_bits=10')
+
+    def test_no_context_takeover(self):
+        options = websocketbase.DeflateOptions()
+        state, response = options.negotiate(
+            'permessage-deflate; server_no_context_takeover; '
+            'client_no_context_takeover')
+        self.assertEqual(response, 'permessage-deflate; '
+                         'server_no_context_takeover; '
+                         'client_no_context_takeover')
+        message = b'the same message again ' * 8
+        first = state.compress(message, True)
+        # without takeover the second copy cannot refer to the first
+        self.assertEqual(state.compress(message, True), first)
+        for i in range(2):
+            self.assertEqual(
+                state.decompress(deflate(message), True, 1 << 20), message)
+
+        state, response = options.negotiate('permessage-deflate')
+        first = state.compress(message, True)
+        self.assertLess(len(state.compress(message, True)), len(first))
+
+
+class InflateTest(unittest.TestCase):
+    def client(self, maxpayload=None):
+        client = Recorder(None, None, None)
+        client.handshaked = True
+        client.messages = []
+        client.deflate, response = websocketbase.DeflateOptions().negotiate(
+            'permessage-deflate')
+        if maxpayload is not None:
+            client.maxpayload = maxpayload
+        return client
+
+    def test_fragmented_message(self):
+        message = u'fragmented \xe9 message ' * 100
+        data = deflate(message.encode('utf-8'))
+        stream = (support.frame(websocketbase.RSV1 | support.TEXT,
+                                data[:10], fin=False, mask=MASK) +
+                  support.frame(support.PING, b'', mask=MASK) +
+                  support.frame(0x0, data[10:20], fin=False, mask=MASK) +
+                  support.frame(0x0, data[20:], mask=MASK))
+        for offset in range(len(stream) + 1):
+            client = self.client()
+            client._parseMessage(stream[:offset])
+            client._parseMessage(stream[offset:])
+            self.assertEqual(client.messages, [message])
+
+    def test_size_limit(self):
+        data = deflate(b'\0' * 100000)
+        stream = (support.frame(websocketbase.RSV1 | support.BINARY,
+                                data[:20], fin=False, mask=MASK) +
+                  support.frame(0x0, data[20:], mask=MASK))
+        client = self.client(maxpayload=65536)
+        self.assertRaises(exceptions.ExcceedSize,
+                          client._parseMessage, stream)
+        client = self.client(maxpayload=200000)
+        client._parseMessage(stream)
+        self.assertEqual(client.messages, [b'\0' * 100000])
+
+    def test_uncompressed_frames_without_rsv1(self):
+        client = self.client()
+        client._parseMessage(support.frame(support.TEXT, b'plain',
+                                           mask=MASK))
+        self.assertEqual(client.messages, [u'plain'])
+
+
+class HandshakeRejectTest(unittest.TestCase):
+    HEADERS = [b'Host: 127.0.0.1',
+               b'Upgrade: websocket',
+               b'Connection: keep-alive, Upgrade',
+               b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==',
+               b'Sec-WebSocket-Version: 13',
+               b'User-Agent: test']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.proxy = support.ProxyThread('ws://127.0.0.1:1/')
+
+    def request(self, replace=None, drop=None):
+        lines = [b'GET / HTTP/1.1']
+        for line in self.HEADERS:
+            name = line.split(b':')[0]
+            if name == drop:
+                continue
+            if replace is not None and name == replace.split(b':')[0]:
+                line = replace
+            lines.append(line)
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    def answer(self, request):
+        sock = socket.create_connection(('127.0.0.1', self.proxy.port), 5)
+        self.addCleanup(sock.close)
+        sock.sendall(request)
+        response = b''
+        while True:
+            data = sock.recv(4096)
+            # the proxy closes the connection after the answer
+            if not data:
+                return response
+            response += data
+
+    def assertRejected(self, request, status):
+        response = self.answer(request)
+        self.assertTrue(response.startswith(b'HTTP/1.1 ' + status + b'\r\n'),
+                        response)
+        return response
+
+    def test_missing_upgrade(self):
+        self.assertRejected(self.request(drop=b'Upgrade'), b'400 Bad Request')
+
+    def test_wrong_upgrade_token(self):
+        self.assertRejected(self.request(b'Upgrade: h2c'), b'400 Bad Request')
+
+    def test_wrong_connection_token(self):
+        self.assertRejected(self.request(b'Connection: keep-alive'),
+                            b'400 Bad Request')
+
+    def test_unsupported_version(self):
+        response = self.assertRejected(
+            self.request(b'Sec-WebSocket-Version: 8'),
+            b'426 Upgrade Required')
+        self.assertIn(b'\r\nSec-WebSocket-Version: 13\r\n', response)
+
+    def test_malformed_key(self):
+        for key in (b'', b'not base64!', b'c2hvcnQ='):
+            self.assertRejected(self.request(b'Sec-WebSocket-Key: ' + key),
+                                b'400 Bad Request')
+
+    def test_malformed_request_line(self):
+        self.assertRejected(b'GET /\r\n\r\n', b'400 Bad Request')
+
+    def test_oversized_header(self):
+        request = self.request()[:-2]
+        request += b'X-Pad: ' + b'a' * (websocketbase.MAXHEADER -
+                                      len(request) - 7)
+        self.assertEqual(len(request), websocketbase.MAXHEADER)
+        self.assertRejected(request, b'400 Bad Request')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import socket
+import threading
+import unittest
+
+import websocket
+
+from tests import support
+from websocketproxy import exceptions
+from websocketproxy import websocketbase
+from websocketproxy.websocketclient import WebSocketClient
+
+
+class BackloggedAttachTest(unittest.TestCase):
+    """An attach socket with a frame only partly written out"""
+
+    def setUp(self):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        ws = websocket.WebSocket()
+        ws.sock = left
+        ws.connected = True
+        self.client = WebSocketClient('ws://127.0.0.1/')
+        self.client.ws = ws
+        self.upstream = support.UpstreamConnection(right)
+
+        self.payload = b'x' * (4 << 20)
+        self.client.send(self.payload)
+        self.assertTrue(self.client.sendq)
+
+    def returns(self, func):
+        # the attach socket blocks, a write on it would hang the loop
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'blocked on the socket')
+        return result[0]
+
+    def drain(self):
+        sock = self.upstream.sock
+        sock.settimeout(0.1)
+        while self.client.sendq:
+            try:
+                self.upstream.buffer += sock.recv(1 << 20)
+            except socket.timeout:
+                pass
+            self.client.flush()
+        sock.settimeout(None)
+
+    def test_ping_is_answered_after_the_pending_frame(self):
+        self.upstream.sock.sendall(support.frame(support.PING, b'beat'))
+        self.assertIsNone(self.returns(self.client.handle_recv))
+
+        self.drain()
+        self.assertEqual(self.upstream.readFrame(),
+                         (0x80, support.BINARY, self.payload))
+        self.assertEqual(self.upstream.readFrame(),
+                         (0x80, support.PONG, b'beat'))
+
+    def test_close_does_not_block(self):
+        self.returns(self.client.close)
+
+
+class PartialFrameTest(unittest.TestCase):
+    """Frames that arrive in pieces, or several per read"""
+
+    def setUp(self):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        ws = websocket.WebSocket()
+        ws.sock = left
+        ws.connected = True
+        self.client = WebSocketClient('ws://127.0.0.1/')
+        self.client.ws = ws
+        self.upstream = right
+
+    def receive(self):
+        # everything handle_recv() returns for one readable event
+        messages = []
+        data = self.client.handle_recv()
+        while data is not None:
+            messages.append(data)
+            data = self.client.handle_recv(False)
+        return messages
+
+    def test_stalled_payload_does_not_block(self):
+        stream = support.frame(support.BINARY, b'y' * 1000)
+        self.upstream.sendall(stream[:20])
+        self.assertEqual(self.receive(), [])
+        self.upstream.sendall(stream[20:])
+        self.assertEqual(self.receive(), [b'y' * 1000])
+
+    def test_many_messages_in_one_read(self):
+        self.upstream.sendall(
+            support.frame(support.TEXT, b'one') +
+            support.frame(support.BINARY, b'tw', fin=False) +
+            support.frame(support.PING, b'beat') +
+            support.frame(0x0, b'o') +
+            support.frame(support.BINARY, b'three'))
+        self.assertEqual(self.receive(), [u'one', b'two', b'three'])
+        pong = support.UpstreamConnection(self.upstream).readFrame()
+        self.assertEqual(pong, (0x80, support.PONG, b'beat'))
+
+    def test_close_after_data(self):
+        self.upstream.sendall(support.frame(support.TEXT, b'bye') +
+                              support.frame(support.CLOSE, b'\x03\xe8'))
+        self.assertEqual(self.client.handle_recv(), u'bye')
+        self.assertRaises(exceptions.Disconnected,
+                          self.client.handle_recv, False)
+
+
+class TLSSocket(object):
+    """Stands in for an SSL socket, which takes one buffer per send."""
+
+    def __init__(self):
+        self.calls = []
+
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, data):
+        self.calls.append(data)
+        return len(data)
+
+
+class SendTLSTest(unittest.TestCase):
+    def send(self, buffers):
+        sock = TLSSocket()
+        client = WebSocketClient('wss://127.0.0.1/')
+        sent = client._send_tls(sock, [memoryview(b) for b in buffers])
+        return sock.calls[0], sent
+
+    def test_large_first_buffer_is_not_copied(self):
+        payload = b'p' * (websocketbase.SENDBUDGET * 8)
+        data, sent = self.send([payload, b'\x82\x01', b'x'])
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual(sent, len(payload))
+
+    def test_joins_only_what_fits(self):
+        payload = b'p' * websocketbase.SENDBUDGET
+        data, sent = self.send([b'\x82\x7e', b'sss', payload])
+        self.assertEqual(data, b'\x82\x7esss')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import socket
+import threading
+import time
+import unittest
+
+import websocket
+
+from tests import support
+from websocketproxy.websocketproxy import WebSocketProxy
+
+
+class UpstreamCloseTest(unittest.TestCase):
+    def setUp(self):
+        def handler(connection):
+            fin, opcode, payload = connection.readFrame()
+            connection.sock.sendall(support.frame(opcode, payload) +
+                                    support.frame(support.BINARY, b'') +
+                                    support.frame(support.CLOSE,
+                                                  b'\x03\xe8'))
+            connection.readFrame()
+
+        self.upstream = support.FakeUpstream(handler)
+        self.proxy = support.ProxyThread(self.upstream.url)
+
+    def tearDown(self):
+        self.upstream.close()
+
+    def test_close_ends_only_that_session(self):
+        # the empty message in between must not be taken for the Close
+        ws = self.proxy.connect()
+        ws.send_binary(b'hello')
+        self.assertEqual(ws.recv(), b'hello')
+        opcode, data = ws.recv_data(control_frame=True)
+        self.assertEqual(opcode, websocket.ABNF.OPCODE_CLOSE)
+        ws.close()
+
+        self.assertTrue(self.proxy.thread.is_alive(), self.proxy.error)
+        ws = self.proxy.connect()
+        ws.send_binary(b'again')
+        self.assertEqual(ws.recv(), b'again')
+        ws.close()
+
+
+class AcceptTest(unittest.TestCase):
+    def test_accepts_every_waiting_connection(self):
+        proxy = WebSocketProxy('127.0.0.1', 0, support.EchoSession,
+                               routes={support.ROUTEID: 'ws://127.0.0.1:1/'})
+        self.addCleanup(proxy.close)
+        address = proxy.serversocket.getsockname()
+        waiting = []
+        for i in range(64):
+            waiting.append(socket.create_connection(address))
+            self.addCleanup(waiting[-1].close)
+        proxy._accept()
+        self.assertEqual(len(proxy.connections), len(waiting))
+        # nothing left, the listener must not block
+        proxy._accept()
+
+
+class StalledUpstreamTest(unittest.TestCase):
+    def test_other_sessions_keep_running(self):
+        stalled = []
+        release = threading.Event()
+
+        def handler(connection):
+            connection.readFrame()
+            if not stalled:
+                stalled.append(connection)
+                stream = support.frame(support.BINARY, b'z' * 1000)
+                connection.sock.sendall(stream[:20])
+                release.wait(10)
+                connection.sock.sendall(stream[20:])
+            else:
+                connection.sock.sendall(support.frame(support.TEXT, b'ok'))
+            connection.readFrame()
+
+        upstream = support.FakeUpstream(handler)
+        self.addCleanup(upstream.close)
+        self.addCleanup(release.set)
+        proxy = support.ProxyThread(upstream.url)
+        first = proxy.connect()
+        first.send_binary(b'go')
+        while not stalled:
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+        second = proxy.connect()
+        second.send_binary(b'go')
+        self.assertEqual(second.recv(), 'ok')
+        second.close()
+
+        release.set()
+        self.assertEqual(first.recv(), b'z' * 1000)
+        first.close()
+
+
+class UpstreamPingTest(unittest.TestCase):
+    def test_ping_between_fragments(self):
+        pongs = []
+        answered = threading.Event()
+
+        def handler(connection):
+            connection.readFrame()
+            connection.sock.sendall(
+                support.frame(support.BINARY, b'frag', fin=False) +
+                support.frame(support.PING, b'beat') +
+                support.frame(0x0, b'ment'))
+            pongs.append(connection.readFrame())
+            answered.set()
+            connection.readFrame()
+
+        upstream = support.FakeUpstream(handler)
+        self.addCleanup(upstream.close)
+        proxy = support.ProxyThread(upstream.url)
+        ws = proxy.connect()
+        ws.send_binary(b'go')
+        self.assertEqual(ws.recv(), b'fragment')
+        ws.close()
+        answered.wait(5)
+        self.assertEqual(pongs, [(0x80, support.PONG, b'beat')])
+
+
+class RelayTest(unittest.TestCase):
+    def test_many_tiny_frames(self):
+        count = 20000
+
+        def handler(connection):
+            connection.readFrame()
+            connection.sock.sendall(
+                support.frame(support.BINARY, b'x') * count +
+                support.frame(support.TEXT, b'done'))
+            connection.readFrame()
+
+        upstream = support.FakeUpstream(handler)
+        self.addCleanup(upstream.close)
+        proxy = support.ProxyThread(upstream.url, relay=True)
+        ws = proxy.connect()
+        ws.send_binary(b'go')
+        received = 0
+        while True:
+            data = ws.recv()
+            if data == 'done':
+                break
+            self.assertEqual(data, b'x')
+            received += 1
+        ws.close()
+        self.assertEqual(received, count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,254 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""asyncio engine for the websocket proxy (Python 3 only)
+
+Every session runs as a client task reading the browser stream and an
+upstream task reading the attach socket. Framing, the handshake and the
+handleConnected/handleMessage/handleClose hooks come from the same
+websocketbase.WebSocket class used by WebSocketProxy.
+"""
+
+import asyncio
+import logging
+import socket
+
+from . import metrics
+from . import websocketbase
+from .routes import createResolver
+
+
+LOG = logging.getLogger(__name__)
+
+# upstream messages read ahead of a slow client before reading pauses
+UPSTREAM_QUEUE = 16
+
+
+class _StreamSocket(object):
+    """Stands in for the client socket of a WebSocket instance."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class _Session(object):
+    def __init__(self, client, writer):
+        self.client = client
+        self.writer = writer
+        self.lock = asyncio.Lock()
+        self.upstreamlock = asyncio.Lock()
+        self.upstream = None
+
+
+class AsyncWebSocketProxy(object):
+    def __init__(self, host, port, websocketclass, reusePort=False,
+                 routes=None, deflate=None):
+        self.host = host
+        # offered to every client, see WebSocketProxy
+        self.deflate = deflate
+        # route ID -> upstream URL, see routes.createResolver()
+        self.routes = createResolver(routes) if routes is not None else None
+        self.port = port
+        self.websocketclass = websocketclass
+        self.reusePort = reusePort
+        self.sessions = {}
+        # shared counter updated with len(self.sessions), see Supervisor
+        self.counter = None
+        self.server = None
+        metrics.REGISTRY.gauge('websocketproxy_connections',
+                               'Open client connections',
+                               lambda: len(self.sessions))
+
+    def _countConnections(self):
+        if self.counter is not None:
+            self.counter.value = len(self.sessions)
+
+    def _constructWebSocket(self, sock, address):
+        client = self.websocketclass(self, sock, address)
+        if self.deflate is not None:
+            client.deflateOptions = self.deflate
+        return client
+
+    async def _flush(self, session):
+        """Write out the sendq, returning True once a Close was sent."""
+        client = session.client
+        async with session.lock:
+            closing = False
+            while client.sendq:
+                opcode, frame = client.sendq.popleft()
+                session.writer.writelines(frame)
+                for buff in frame:
+                    client.sendqbytes -= len(buff)
+                    metrics.CLIENT_BYTES_OUT.inc(len(buff))
+                if opcode == websocketbase.CLOSE:
+                    closing = True
+                    break
+            await session.writer.drain()
+            return closing
+
+    async def _flushTarget(self, session):
+        """Wait until the attach socket took everything queued for it."""
+        loop = asyncio.get_event_loop()
+        target = session.client.target
+        async with session.upstreamlock:
+            if target is None or target.ws is None:
+                return
+            while not target.flush():
+                writable = loop.create_future()
+                fileno = target.ws.fileno()
+                loop.add_writer(fileno, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    loop.remove_writer(fileno)
+
+    def broadcast(self, data, connections=None):
+        """Send one message to many clients, see WebSocketProxy.broadcast()"""
+        if connections is None:
+            connections = list(self.sessions)
+        frame = websocketbase.encodeFrame(data)
+        count = 0
+        for client in connections:
+            session = self.sessions.get(client)
+            if session is None or not client.handshaked or client.closed:
+                continue
+            client.sendFrame(frame)
+            asyncio.ensure_future(self._flush(session))
+            count += 1
+        return count
+
+    def _attachTarget(self, client):
+        session = self.sessions[client]
+        session.upstream = asyncio.ensure_future(self._handleUpstream(session))
+
+    async def _handleUpstream(self, session):
+        loop = asyncio.get_event_loop()
+        client = session.client
+        target = client.target
+        try:
+            if target.ws is None and not target.attach_ready():
+                try:
+                    ws = await loop.run_in_executor(None,
+                                                    target.create_connection)
+                except Exception:
+                    client.close(1011, u'upstream connect failed')
+                    await self._flush(session)
+                    return
+                target.attach(ws)
+                await self._flushTarget(session)
+
+            # handle_recv() never blocks, read whatever the socket has
+            # from the reader callback and hand the messages it completes
+            # to this task through a queue
+            received = asyncio.Queue()
+            fileno = target.ws.fileno()
+
+            def onReadable():
+                try:
+                    read = True
+                    while True:
+                        data = target.handle_recv(read)
+                        if data is None:
+                            # decrypted TLS bytes wake no reader
+                            if not target.pending():
+                                break
+                            read = True
+                            continue
+                        read = False
+                        received.put_nowait(data)
+                except Exception as e:
+                    received.put_nowait(e)
+                if target.sendq:
+                    # a PONG the socket did not take right away
+                    asyncio.ensure_future(self._flushTarget(session))
+                if received.qsize() >= UPSTREAM_QUEUE:
+                    loop.remove_reader(fileno)
+
+            loop.add_reader(fileno, onReadable)
+            try:
+                while True:
+                    data = await received.get()
+                    if isinstance(data, Exception):
+                        raise data
+                    metrics.UPSTREAM_BYTES_IN.inc(len(data))
+                    client.sendMessage(data)
+                    if await self._flush(session):
+                        return
+                    if received.qsize() == UPSTREAM_QUEUE - 1:
+                        # the writer drained, start reading again
+                        loop.add_reader(fileno, onReadable)
+            finally:
+                loop.remove_reader(fileno)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            LOG.debug('upstream of %s failed', client.address, exc_info=True)
+        finally:
+            # wakes the client task, which tears the session down
+            session.writer.close()
+
+    async def _handleClient(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        client = self._constructWebSocket(_StreamSocket(writer), address)
+        session = _Session(client, writer)
+        self.sessions[client] = session
+        self._countConnections()
+        try:
+            while True:
+                if client.handshaked:
+                    data = await reader.read(16384)
+                else:
+                    data = await reader.read(client.headertoread)
+                if not data:
+                    break
+                client._processData(data, self)
+                if await self._flush(session):
+                    break
+                # stop reading the client while upstream is backlogged
+                await self._flushTarget(session)
+        except Exception:
+            LOG.debug('client %s failed', address, exc_info=True)
+        finally:
+            del self.sessions[client]
+            self._countConnections()
+            if session.upstream is not None:
+                session.upstream.cancel()
+            if client.target is not None:
+                client.target.close()
+            writer.close()
+            client.handleClose()
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self._handleClient,
+                                                 self.host, self.port,
+                                                 reuse_address=True,
+                                                 reuse_port=self.reusePort,
+                                                 backlog=socket.SOMAXCONN)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for session in list(self.sessions.values()):
+            session.client.close()
+            while session.client.sendq:
+                opcode, frame = session.client.sendq.popleft()
+                session.writer.writelines(frame)
+            session.writer.close()
+
+    def proxy(self):
+        """Run until interrupted on the current event loop policy."""
+        asyncio.run(self.serve())
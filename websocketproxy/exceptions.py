@@ -83,5 +83,9 @@ class RSVBitError(WebSocketException):
     message = "RSV bit must be 0"
 
 
+class InflateError(WebSocketException):
+    message = "invalid compressed payload"
+
+
 class ReceivedClientClose(WebSocketException):
     message = "received client closed"
@@ -0,0 +1,171 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Process wide counters and histograms in Prometheus text format
+
+Updating a metric is a single addition, so the parser and the loop
+can count every frame. Gauges are callables sampled only when the stats
+page is rendered. With the Supervisor every worker process keeps its own
+registry and serves its own numbers.
+"""
+
+import bisect
+
+
+# upper bounds in seconds shared by all histograms
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % item
+                             for item in sorted(labels.items()))
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [(self.name + _labels(self.labels), self.value)]
+
+
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.func = func
+
+    def samples(self):
+        return [(self.name + _labels(self.labels), self.func())]
+
+
+class Histogram(object):
+    """Observations counted into the fixed BUCKETS"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=None, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = buckets
+        # one more slot for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = []
+        total = 0
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            labels = dict(self.labels, le=bound)
+            samples.append((self.name + '_bucket' + _labels(labels), total))
+        samples.append((self.name + '_sum' + _labels(self.labels),
+                        self.sum))
+        samples.append((self.name + '_count' + _labels(self.labels),
+                        self.count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        # (name, labels) -> metric, in registration order
+        self.metrics = {}
+        self.order = []
+
+    def _add(self, metric):
+        key = (metric.name, _labels(metric.labels))
+        if key not in self.metrics:
+            self.order.append(key)
+        self.metrics[key] = metric
+        return metric
+
+    def counter(self, name, help, labels=None):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, func, labels=None):
+        """Register func() as a gauge, replacing an older one."""
+        return self._add(Gauge(name, help, func, labels))
+
+    def histogram(self, name, help, labels=None):
+        return self._add(Histogram(name, help, labels))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for key in self.order:
+            metric = self.metrics[key]
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append('# HELP %s %s' % (metric.name, metric.help))
+                lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append('%s %s' % (sample, value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+_BYTES = 'websocketproxy_bytes_total'
+_BYTES_HELP = 'Bytes transferred by direction'
+CLIENT_BYTES_IN = REGISTRY.counter(_BYTES, _BYTES_HELP,
+                                   {'direction': 'client_in'})
+CLIENT_BYTES_OUT = REGISTRY.counter(_BYTES, _BYTES_HELP,
+                                    {'direction': 'client_out'})
+UPSTREAM_BYTES_IN = REGISTRY.counter(_BYTES, _BYTES_HELP,
+                                     {'direction': 'upstream_in'})
+UPSTREAM_BYTES_OUT = REGISTRY.counter(_BYTES, _BYTES_HELP,
+                                      {'direction': 'upstream_out'})
+
+_FRAMES = 'websocketproxy_frames_total'
+_FRAMES_HELP = 'Websocket frames decoded from or queued for clients'
+CLIENT_FRAMES_IN = REGISTRY.counter(_FRAMES, _FRAMES_HELP,
+                                    {'direction': 'client_in'})
+CLIENT_FRAMES_OUT = REGISTRY.counter(_FRAMES, _FRAMES_HELP,
+                                     {'direction': 'client_out'})
+
+HANDSHAKES = REGISTRY.counter('websocketproxy_handshakes_total',
+                              'Completed websocket upgrades')
+UPSTREAM_CONNECT_SECONDS = REGISTRY.histogram(
+    'websocketproxy_upstream_connect_seconds',
+    'Time to open an attach socket in the background')
+LOOP_SECONDS = REGISTRY.histogram(
+    'websocketproxy_loop_seconds',
+    'Time spent handling the events of one poll, without the wait')
+
+_TLS = 'websocketproxy_tls_handshakes_total'
+_TLS_HELP = 'Completed TLS handshakes with clients'
+TLS_FULL = REGISTRY.counter(_TLS, _TLS_HELP, {'resumed': 'no'})
+TLS_RESUMED = REGISTRY.counter(_TLS, _TLS_HELP, {'resumed': 'yes'})
@@ -0,0 +1,180 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import select
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+
+READ = 0x1
+WRITE = 0x2
+
+
+def _fileno(fileobj):
+    if isinstance(fileobj, int):
+        return fileobj
+    return fileobj.fileno()
+
+
+class SelectPoller(object):
+    """select() fallback
+
+    Rebuilds the descriptor sets on every poll and is limited to
+    FD_SETSIZE descriptors, but works on every platform.
+    """
+
+    def __init__(self):
+        self.fileobjs = {}
+
+    def register(self, fileobj, events):
+        self.fileobjs[_fileno(fileobj)] = (fileobj, events)
+
+    def modify(self, fileobj, events):
+        self.fileobjs[_fileno(fileobj)] = (fileobj, events)
+
+    def unregister(self, fileobj):
+        self.fileobjs.pop(_fileno(fileobj), None)
+
+    def poll(self, timeout=None):
+        readers = []
+        writers = []
+        for fd, (fileobj, events) in self.fileobjs.items():
+            if events & READ:
+                readers.append(fd)
+            if events & WRITE:
+                writers.append(fd)
+
+        rList, wList, _ = select.select(readers, writers, [], timeout)
+
+        ready = {}
+        for fd in rList:
+            ready[fd] = READ
+        for fd in wList:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return [(self.fileobjs[fd][0], events)
+                for fd, events in ready.items()]
+
+    def close(self):
+        self.fileobjs.clear()
+
+
+class EpollPoller(object):
+    """epoll poller for Linux interpreters without the selectors module
+
+    Hangups and errors are reported as READ so that the following recv()
+    surfaces the failure to the caller.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.fileobjs = {}
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fileobj, events):
+        fd = _fileno(fileobj)
+        self.epoll.register(fd, self._mask(events))
+        self.fileobjs[fd] = fileobj
+
+    def modify(self, fileobj, events):
+        self.epoll.modify(_fileno(fileobj), self._mask(events))
+
+    def unregister(self, fileobj):
+        fd = _fileno(fileobj)
+        if self.fileobjs.pop(fd, None) is not None:
+            self.epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        ready = []
+        for fd, mask in self.epoll.poll(timeout):
+            events = 0
+            if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                events |= READ
+            if mask & select.EPOLLOUT:
+                events |= WRITE
+            fileobj = self.fileobjs.get(fd)
+            if fileobj is not None:
+                ready.append((fileobj, events))
+        return ready
+
+    def close(self):
+        self.epoll.close()
+        self.fileobjs.clear()
+
+
+class SelectorsPoller(object):
+    """selectors.DefaultSelector poller, epoll on Linux"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= selectors.EVENT_READ
+        if events & WRITE:
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    def register(self, fileobj, events):
+        self.selector.register(fileobj, self._mask(events))
+
+    def modify(self, fileobj, events):
+        # selectors refuses an empty mask, so drop the descriptor until it
+        # gets an interest again
+        if not events:
+            self.unregister(fileobj)
+        elif fileobj in self.selector.get_map():
+            self.selector.modify(fileobj, self._mask(events))
+        else:
+            self.selector.register(fileobj, self._mask(events))
+
+    def unregister(self, fileobj):
+        try:
+            self.selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def poll(self, timeout=None):
+        ready = []
+        for key, mask in self.selector.select(timeout):
+            events = 0
+            if mask & selectors.EVENT_READ:
+                events |= READ
+            if mask & selectors.EVENT_WRITE:
+                events |= WRITE
+            ready.append((key.fileobj, events))
+        return ready
+
+    def close(self):
+        self.selector.close()
+
+
+def createPoller():
+    """Return the most scalable poller available on this platform."""
+    if selectors is not None:
+        return SelectorsPoller()
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    return SelectPoller()
@@ -0,0 +1,150 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Route resolvers mapping a route ID to an upstream attach URL
+
+A resolver has resolve(routeid), returning the URL or None for unknown
+IDs, and urls(), the URLs it knows ahead of any lookup. WebSocketProxy
+keeps one in self.routes, see createResolver().
+"""
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import six
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+
+class StaticRoutes(object):
+    """Routes from a dict given at startup"""
+
+    def __init__(self, table):
+        self.table = dict(table)
+
+    def resolve(self, routeid):
+        return self.table.get(routeid)
+
+    def urls(self):
+        return list(self.table.values())
+
+
+class FileRoutes(StaticRoutes):
+    """Routes from a JSON object file, reloaded when the file changes
+
+    The file is checked at most every interval seconds. A changed file is
+    parsed completely before the table is swapped, so lookups see either
+    the old or the new routes; a file that fails to parse is logged and
+    the old routes stay in use. Replace the file with a rename to avoid
+    reading it half written. clock returns the current time in seconds.
+    """
+
+    def __init__(self, path, interval=1.0, clock=time.time):
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.stamp = None
+        self.nextcheck = 0
+        StaticRoutes.__init__(self, self._load())
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _load(self):
+        stamp = self._stat()
+        with open(self.path) as f:
+            table = json.load(f)
+        if not isinstance(table, dict) or not all(
+                isinstance(url, six.string_types) for url in table.values()):
+            raise ValueError('%s must map route IDs to URLs' % self.path)
+        self.stamp = stamp
+        return table
+
+    def reload(self):
+        """Read the file again if it changed since the last load."""
+        try:
+            if self._stat() != self.stamp:
+                self.table = self._load()
+                LOG.info('loaded %d routes from %s', len(self.table),
+                         self.path)
+        except (IOError, OSError, ValueError) as e:
+            LOG.warning('keeping the old routes, reading %s failed: %s',
+                        self.path, e)
+
+    def resolve(self, routeid):
+        now = self.clock()
+        if now >= self.nextcheck:
+            self.nextcheck = now + self.interval
+            self.reload()
+        return self.table.get(routeid)
+
+
+class CachedRoutes(object):
+    """Routes looked up by a callable, with an LRU cache in front
+
+    lookup(routeid) returns a URL or None. Found routes are cached for ttl
+    seconds, unknown IDs for negativeTTL seconds, and beyond size entries
+    the least recently used one is evicted. clock returns the current
+    time in seconds.
+    """
+
+    def __init__(self, lookup, ttl=60, negativeTTL=5, size=10000,
+                 clock=time.time):
+        self.lookup = lookup
+        self.clock = clock
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.size = size
+        # routeid -> (expiry, url), oldest use first
+        self.cache = OrderedDict()
+
+    def resolve(self, routeid):
+        now = self.clock()
+        entry = self.cache.pop(routeid, None)
+        if entry is None or entry[0] <= now:
+            url = self.lookup(routeid)
+            ttl = self.ttl if url is not None else self.negativeTTL
+            entry = (now + ttl, url)
+            if len(self.cache) >= self.size:
+                self.cache.popitem(last=False)
+        self.cache[routeid] = entry
+        return entry[1]
+
+    def invalidate(self, routeid=None):
+        """Forget one cached route, or all of them."""
+        if routeid is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(routeid, None)
+
+    def urls(self):
+        return []
+
+
+def createResolver(source):
+    """Build a resolver from a JSON file path, a dict or a lookup callable
+
+    Objects that already have resolve() are used as they are.
+    """
+    if hasattr(source, 'resolve'):
+        return source
+    if isinstance(source, six.string_types):
+        return FileRoutes(source)
+    if isinstance(source, dict):
+        return StaticRoutes(source)
+    if callable(source):
+        return CachedRoutes(source)
+    raise TypeError('cannot resolve routes with %r' % (source,))
@@ -0,0 +1,140 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from .websocketproxy import WebSocketProxy
+
+
+LOG = logging.getLogger(__name__)
+
+# a worker dying sooner than this after its start is restarted with a delay
+RESTART_BACKOFF = 1.0
+
+
+class Supervisor(object):
+    """Run one proxy event loop per worker process
+
+    Every worker binds its own SO_REUSEPORT socket on the same port, so the
+    kernel spreads accepts over all of them. Workers that die are forked
+    again, and the number of open connections of every worker is kept in
+    shared memory so the supervisor can report the total.
+    """
+
+    def __init__(self, host, port, websocketclass, workers=None,
+                 proxyclass=WebSocketProxy, reportInterval=60, **kwargs):
+        self.host = host
+        self.port = port
+        self.websocketclass = websocketclass
+        self.workers = workers or multiprocessing.cpu_count()
+        self.proxyclass = proxyclass
+        self.reportInterval = reportInterval
+        self.kwargs = kwargs
+
+        self.counters = [multiprocessing.RawValue('l', 0)
+                         for i in range(self.workers)]
+        # pid -> (worker index, start time)
+        self.children = {}
+        self.stopping = False
+
+    def connectionCount(self):
+        """Total open client connections over all workers."""
+        return sum(counter.value for counter in self.counters)
+
+    def _runWorker(self, index):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        server = self.proxyclass(self.host, self.port, self.websocketclass,
+                                 reusePort=True, **self.kwargs)
+        server.counter = self.counters[index]
+        server.proxy()
+
+    def _spawn(self, index):
+        self.counters[index].value = 0
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._runWorker(index)
+                status = 0
+            except Exception:
+                LOG.exception('worker %d failed', index)
+            finally:
+                os._exit(status)
+
+        LOG.info('started worker %d as pid %d', index, pid)
+        self.children[pid] = (index, time.time())
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+
+            index, started = self.children.pop(pid)
+            self.counters[index].value = 0
+            if self.stopping:
+                continue
+
+            LOG.warning('worker %d (pid %d) exited with status %d',
+                        index, pid, status)
+            if time.time() - started < RESTART_BACKOFF:
+                time.sleep(RESTART_BACKOFF)
+            self._spawn(index)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def proxy(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for index in range(self.workers):
+            self._spawn(index)
+
+        nextReport = time.time() + self.reportInterval
+        try:
+            while not self.stopping:
+                self._reap()
+                if time.time() >= nextReport:
+                    LOG.info('%d workers, %d connections',
+                             len(self.children), self.connectionCount())
+                    nextReport = time.time() + self.reportInterval
+                time.sleep(0.5)
+        finally:
+            self.stopping = True
+            for pid in list(self.children):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            while self.children:
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    break
+                self.children.pop(pid, None)
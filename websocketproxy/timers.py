@@ -0,0 +1,108 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Hashed timing wheel for per-connection timeouts
+
+Deadlines are rounded up to whole ticks and hashed into a fixed ring of
+slots, so scheduling, moving and cancelling a timer are a set insert and
+removal no matter how many timers exist. Timers fire up to one tick late,
+which is fine for keepalives and idle timeouts measured in seconds.
+"""
+
+import math
+import time
+
+
+# the clock timers are measured against, immune to wall clock steps
+# where the interpreter has one
+now = getattr(time, 'monotonic', time.time)
+
+
+class Timer(object):
+    __slots__ = ('callback', 'args', 'deadline', 'tick')
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.deadline = None
+        # absolute tick number, None while not scheduled
+        self.tick = None
+
+
+class TimerWheel(object):
+    def __init__(self, tick=0.5, slots=512, clock=now):
+        self.resolution = tick
+        self.slots = [set() for i in range(slots)]
+        # ticks up to this one are expired
+        self.current = int(clock() / tick)
+        self.count = 0
+        # no timer is due before this tick, saves rescanning empty slots
+        self.earliest = self.current + 1
+
+    def schedule(self, deadline, callback, *args):
+        """Call callback(*args) once deadline has passed."""
+        timer = Timer(callback, args)
+        self.reschedule(timer, deadline)
+        return timer
+
+    def reschedule(self, timer, deadline):
+        self.cancel(timer)
+        tick = max(self.current + 1,
+                   int(math.ceil(deadline / self.resolution)))
+        timer.deadline = deadline
+        timer.tick = tick
+        self.slots[tick % len(self.slots)].add(timer)
+        self.count += 1
+        self.earliest = min(self.earliest, tick)
+
+    def cancel(self, timer):
+        if timer.tick is not None:
+            self.slots[timer.tick % len(self.slots)].discard(timer)
+            timer.tick = None
+            self.count -= 1
+
+    def nextDeadline(self):
+        """When expire() has work next, or None without timers
+
+        The answer can be early when the first busy slot only holds timers
+        for a later turn of the wheel; expire() then finds nothing to do.
+        """
+        if not self.count:
+            return None
+        size = len(self.slots)
+        start = max(self.current + 1, self.earliest)
+        for tick in range(start, start + size):
+            if self.slots[tick % size]:
+                self.earliest = tick
+                return tick * self.resolution
+        return None
+
+    def expire(self, when):
+        """Run the callbacks of all timers due at when."""
+        target = int(when / self.resolution)
+        size = len(self.slots)
+        # a long stall visits every slot once, not every missed tick
+        first = max(self.current + 1, target - size + 1)
+        due = []
+        for tick in range(first, target + 1):
+            slot = self.slots[tick % size]
+            for timer in [t for t in slot if t.tick <= target]:
+                slot.remove(timer)
+                timer.tick = None
+                self.count -= 1
+                due.append(timer)
+        self.current = max(self.current, target)
+
+        for timer in due:
+            # an earlier callback may have scheduled it again
+            if timer.tick is None:
+                timer.callback(*timer.args)
@@ -0,0 +1,84 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""TLS for client connections terminated by the proxy
+
+Sockets are wrapped without handshaking; WebSocketProxy drives the
+handshake from its loop and polls for whichever direction OpenSSL is
+waiting on.
+"""
+
+import ssl
+import time
+
+from . import metrics
+
+
+# an SSL socket operation has to wait for the socket to become readable
+# or writable, whatever poll() said before
+WANTREAD = ssl.SSLWantReadError
+WANTWRITE = ssl.SSLWantWriteError
+
+PROTOCOL = getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23)
+
+
+class ServerTLS(object):
+    """The server side SSLContext shared by all client connections
+
+    One context means one OpenSSL session cache and one session ticket
+    key for every client, so a returning browser resumes its session with
+    an abbreviated handshake. Every rotate seconds a new context replaces
+    the current one, which retires the ticket key; clients holding a
+    ticket for the old key get a full handshake and a new ticket.
+
+    Create it before the Supervisor forks and all workers start with the
+    same ticket key, so resumption works whichever worker the kernel picks.
+    After the first rotation every worker has its own key.
+    """
+
+    def __init__(self, certfile, keyfile=None, rotate=3600, ciphers=None):
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.rotate = rotate
+        self.ciphers = ciphers
+        self.context = None
+        self.rotateAt = 0
+        self.currentContext()
+
+    def _createContext(self):
+        context = ssl.SSLContext(PROTOCOL)
+        context.options |= getattr(ssl, 'OP_NO_SSLv2', 0)
+        context.options |= getattr(ssl, 'OP_NO_SSLv3', 0)
+        context.options |= getattr(ssl, 'OP_NO_COMPRESSION', 0)
+        context.load_cert_chain(self.certfile, self.keyfile)
+        if self.ciphers is not None:
+            context.set_ciphers(self.ciphers)
+        return context
+
+    def currentContext(self):
+        now = time.time()
+        if now >= self.rotateAt:
+            self.context = self._createContext()
+            self.rotateAt = now + self.rotate
+        return self.context
+
+    def wrap(self, sock):
+        """Wrap an accepted socket, the handshake is left to the caller."""
+        return self.currentContext().wrap_socket(
+            sock, server_side=True, do_handshake_on_connect=False)
+
+
+def countHandshake(sock):
+    if getattr(sock, 'session_reused', False):
+        metrics.TLS_RESUMED.inc()
+    else:
+        metrics.TLS_FULL.inc()
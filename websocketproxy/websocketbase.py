@@ -18,27 +18,91 @@
 
 
 import base64
-from BaseHTTPServer import BaseHTTPRequestHandler
+import binascii
 import codecs
 from collections import deque
 import errno
-import exceptions
 import hashlib
+import os
+import six
 import socket
-from StringIO import StringIO
+import ssl
 import struct
+import zlib
+
+from . import exceptions
+from . import metrics
 
 
 def _check_unicode(val):
-    return isinstance(val, unicode)
+    return isinstance(val, six.text_type)
+
+
+class _Headers(dict):
+    """Header values by case-insensitive name"""
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+    def add(self, name, value):
+        name = name.lower()
+        if dict.__contains__(self, name):
+            # repeated headers are equivalent to one comma separated list
+            value = dict.__getitem__(self, name) + ', ' + value
+        dict.__setitem__(self, name, value)
+
+    def tokens(self, name):
+        return [token.strip().lower()
+                for token in self.get(name, '').split(',')]
+
+
+class HTTPRequest(object):
+    """Request line and headers of the opening handshake
 
+    request_text is the request up to, not including, the blank line.
+    Raises ValueError when it is not a well formed HTTP/1.1 request.
+    """
 
-class HTTPRequest(BaseHTTPRequestHandler):
     def __init__(self, request_text):
-        self.rfile = StringIO(request_text)
-        self.raw_requestline = self.rfile.readline()
-        self.error_code = self.error_message = None
-        self.parse_request()
+        lines = bytes(request_text).decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise ValueError('bad request line %r' % lines[0])
+        self.command, self.path, self.request_version = parts
+
+        self.headers = _Headers()
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            # folded continuation lines are obsolete, refuse them too
+            if not sep or not name or name != name.strip():
+                raise ValueError('bad header line %r' % line)
+            self.headers.add(name, value.strip())
+
+    def checkUpgrade(self):
+        """Validate a version 13 websocket upgrade and return its key."""
+        if self.command != 'GET' or self.request_version != 'HTTP/1.1':
+            raise ValueError('not a GET HTTP/1.1 request')
+        if 'websocket' not in self.headers.tokens('Upgrade'):
+            raise ValueError('missing Upgrade: websocket')
+        if 'upgrade' not in self.headers.tokens('Connection'):
+            raise ValueError('missing Connection: Upgrade')
+        if self.headers.get('Sec-WebSocket-Version') != '13':
+            raise ValueError('unsupported Sec-WebSocket-Version')
+
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        try:
+            nonce = base64.b64decode(key.encode('ascii'))
+        except (TypeError, ValueError):
+            nonce = b''
+        if len(nonce) != 16:
+            raise ValueError('bad Sec-WebSocket-Key')
+        return key
 
 _VALID_STATUS_CODES = [1000, 1001, 1002, 1003, 1007, 1008,
                        1009, 1010, 1011, 3000, 3999, 4000, 4999]
@@ -48,6 +112,26 @@ HANDSHAKE_STR = ("HTTP/1.1 101 Switching Protocols\r\n"
                  "Connection: Upgrade\r\n"
                  "Sec-WebSocket-Accept: %(acceptstr)s\r\n\r\n")
 
+EXTENSIONS_STR = "Sec-WebSocket-Extensions: %s\r\n"
+
+STATS_STR = ("HTTP/1.1 200 OK\r\n"
+             "Content-Type: text/plain; version=0.0.4\r\n"
+             "Content-Length: %d\r\n"
+             "Connection: close\r\n\r\n")
+
+# plain GET requests for this path are answered with the metrics
+STATS_PATH = '/stats'
+
+# answers to requests that are no valid version 13 upgrade
+BAD_REQUEST_STR = ("HTTP/1.1 400 Bad Request\r\n"
+                   "Connection: close\r\n"
+                   "Content-Length: 0\r\n\r\n")
+
+UPGRADE_REQUIRED_STR = ("HTTP/1.1 426 Upgrade Required\r\n"
+                        "Sec-WebSocket-Version: 13\r\n"
+                        "Connection: close\r\n"
+                        "Content-Length: 0\r\n\r\n")
+
 GUID_STR = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
 
 STREAM = 0x0
@@ -58,45 +142,519 @@ PING = 0x9
 PONG = 0xA
 
 HEADERB1 = 1
-HEADERB2 = 3
-LENGTHSHORT = 4
-LENGTHLONG = 5
-MASK = 6
 MAXHEADER = 65536
 MAXPAYLOAD = 33554432
 PAYLOAD = 7
 
+# the only RSV bit in use, marks a permessage-deflate compressed message
+RSV1 = 0x40
+
+
+# python 2 sockets have no gather write
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+# an SSL socket has to wait for the peer, like EAGAIN on a plain one
+_SSL_WANT = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+# limits for one coalesced write of the sendq
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+SENDBUDGET = 262144
+
+# size of one client read, and how many idle receive buffers are kept
+RECVSIZE = 16384
+RECVSPARE = 8
+
+_HEADER = struct.Struct('!BB')
+_LENGTHSHORT = struct.Struct('!H')
+_LENGTHLONG = struct.Struct('!Q')
+
+
+def _decodeHeader(data, offset, size):
+    """Decode the frame header starting at data[offset].
+
+    Returns (fin, opcode, rsv, hasmask, length, mask, headerlen) or None when
+    fewer than headerlen bytes are available yet.
+    """
+    if size - offset < 2:
+        return None
+
+    b1, b2 = _HEADER.unpack_from(data, offset)
+    hasmask = b2 & 0x80 == 0x80
+    length = b2 & 0x7F
+    headerlen = 2
+    if length == 126:
+        headerlen = 4
+    elif length == 127:
+        headerlen = 10
+    if hasmask:
+        headerlen += 4
+
+    if size - offset < headerlen:
+        return None
+
+    if length == 126:
+        length = _LENGTHSHORT.unpack_from(data, offset + 2)[0]
+    elif length == 127:
+        length = _LENGTHLONG.unpack_from(data, offset + 2)[0]
+
+    mask = None
+    if hasmask:
+        mask = bytearray(data[offset + headerlen - 4:offset + headerlen])
+
+    return b1 & 0x80, b1 & 0x0F, b1 & 0x70, hasmask, length, mask, headerlen
+
+
+def _encodeHeader(fin, opcode, length, masked=False, compressed=False):
+    # fin is False for the last frame of a message, see sendFragment()
+    b1 = opcode
+    if fin is False:
+        b1 |= 0x80
+    if compressed:
+        b1 |= RSV1
+    b2 = 0x80 if masked else 0
+
+    if length <= 125:
+        return _HEADER.pack(b1, b2 | length)
+    elif length <= 65535:
+        return _HEADER.pack(b1, b2 | 126) + _LENGTHSHORT.pack(length)
+    return _HEADER.pack(b1, b2 | 127) + _LENGTHLONG.pack(length)
+
+
+def encodeFrame(data):
+    """Frame a message once for sending to many connections
+
+    Returns an (opcode, buffers) pair for WebSocket.sendFrame(). The
+    buffers are immutable, so every sendq can hold the same ones. The frame
+    is never compressed, because permessage-deflate state differs between
+    connections.
+    """
+    opcode = BINARY
+    if _check_unicode(data):
+        opcode = TEXT
+        data = data.encode('utf-8')
+    elif not isinstance(data, bytes):
+        data = bytes(data)
+    header = _encodeHeader(False, opcode, len(data))
+    if data:
+        return opcode, (header, data)
+    return opcode, (header,)
+
+
+def _encodeMaskedFrame(opcode, data):
+    """Encode a single frame the way a client must send it."""
+    mask = bytearray(os.urandom(4))
+    header = _encodeHeader(False, opcode, len(data), masked=True)
+    return (header, bytes(mask), _unmask(data, mask))
+
+
+def _unmask(data, mask, offset=0):
+    """XOR data with the 4 byte mask as if it started at payload offset.
+
+    The key is repeated to the span length and applied as one big integer
+    XOR, so the work happens in C instead of once per byte. data may be a
+    memoryview; the result is new bytes.
+    """
+    length = len(data)
+    if length == 0:
+        return b''
+
+    shift = offset % 4
+    if shift:
+        mask = mask[shift:] + mask[:shift]
+    key = memoryview(mask * (length // 4 + 1))[:length]
+
+    if six.PY3:
+        value = int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')
+        return value.to_bytes(length, 'big')
+
+    value = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(key), 16)
+    return binascii.unhexlify('%0*x' % (length * 2, value))
+
+
+class FrameRelay(object):
+    """Forward a websocket byte stream without decoding its messages
+
+    Only frame headers are parsed. Data frames are handed to output() as
+    the original header and payload bytes, span by span as they arrive,
+    so masking, fragmentation and payload encoding pass through unchanged.
+    Control frames are not forwarded; once complete they are unmasked and
+    passed to control(opcode, payload).
+
+    Frames the proxy itself writes into the output stream have to go
+    through defer() or deferControl(). Data frames are held back until
+    the message being forwarded is complete, control frames only until
+    the frame is (RFC 6455 5.4). Held frames keep their order.
+    """
+
+    def __init__(self, output, control):
+        self.output = output
+        self.control = control
+        self.framebuffer = bytearray()
+        self.opcode = None
+        self.fin = 0
+        self.mask = None
+        self.remaining = 0
+        self.payload = None
+        # the last data frame forwarded did not finish its message
+        self.fragmented = False
+        # (callback, args, control) waiting for a boundary
+        self.held = []
+
+    def midFrame(self):
+        """A data frame is only partly forwarded."""
+        return self.payload is None and self.remaining > 0
+
+    def defer(self, callback, *args):
+        """Run callback(*args) at the next message boundary of the output."""
+        if self.held or self.midFrame() or self.fragmented:
+            self.held.append((callback, args, False))
+        else:
+            callback(*args)
+
+    def deferControl(self, callback, *args):
+        """Run callback(*args) at the next frame boundary of the output."""
+        if self.held or self.midFrame():
+            self.held.append((callback, args, True))
+        else:
+            callback(*args)
+
+    def _releasable(self):
+        return self.held and (self.held[0][2] or not self.fragmented)
+
+    def _frameDone(self, buffers):
+        if self.payload is not None:
+            opcode, payload = self.opcode, self.payload
+            if self.mask is not None:
+                payload = _unmask(payload, self.mask)
+            self.payload = None
+            if buffers:
+                self.output(buffers)
+            self.control(opcode, payload)
+            return []
+
+        self.fragmented = not self.fin
+        if self._releasable():
+            if buffers:
+                self.output(buffers)
+            while self._releasable():
+                callback, args, control = self.held.pop(0)
+                callback(*args)
+            return []
+        return buffers
+
+    def feed(self, data):
+        if self.framebuffer:
+            self.framebuffer.extend(data)
+            data = self.framebuffer
+            self.framebuffer = bytearray()
+
+        view = memoryview(data)
+        buffers = []
+        offset = 0
+        size = len(data)
+        while offset < size:
+            if self.remaining == 0:
+                header = _decodeHeader(data, offset, size)
+                if header is None:
+                    # wait for the rest of the header
+                    self.framebuffer.extend(data[offset:])
+                    break
+
+                fin, opcode, rsv, hasmask, length, mask, headerlen = header
+                if opcode in (CLOSE, PING, PONG):
+                    if length > 125:
+                        raise exceptions.ControlFrameOverLimit()
+                    if not fin:
+                        raise exceptions.MessageFragmentFail()
+                    self.payload = bytearray()
+                    self.mask = mask
+                elif opcode in (STREAM, TEXT, BINARY):
+                    buffers.append(view[offset:offset + headerlen])
+                else:
+                    raise exceptions.UnknownOPCCode(opcode)
+
+                self.opcode = opcode
+                self.fin = fin
+                self.remaining = length
+                offset += headerlen
+            else:
+                end = min(size, offset + self.remaining)
+                if self.payload is not None:
+                    self.payload.extend(data[offset:end])
+                else:
+                    buffers.append(view[offset:end])
+                self.remaining -= end - offset
+                offset = end
+
+            if self.remaining == 0:
+                buffers = self._frameDone(buffers)
+
+        if buffers:
+            self.output(buffers)
+
+
+def _windowBits(value):
+    try:
+        bits = int(value)
+    except ValueError:
+        return None
+    if str(bits) != value or not 8 <= bits <= 15:
+        return None
+    return bits
+
+
+class DeflateOptions(object):
+    """permessage-deflate settings (RFC 7692)
+
+    windowBits and memLevel bound the compressor of a connection to about
+    (1 << (windowBits + 2)) + (1 << (memLevel + 9)) bytes, clientWindowBits
+    the decompressor to 1 << clientWindowBits bytes. Without context
+    takeover that state is dropped after every message instead of being
+    kept for the life of the connection. Messages shorter than minSize are
+    sent uncompressed.
+
+    With the defaults every session that negotiated the extension keeps
+    about 256 KiB of compressor and 32 KiB of decompressor state for as
+    long as it is open, and every message costs CPU to compress. Browsers
+    always offer the extension, so it is off unless the proxy is given
+    options; smaller windows, a lower memLevel or no context takeover
+    trade compression ratio for memory.
+    """
+
+    def __init__(self, windowBits=15, clientWindowBits=15,
+                 contextTakeover=True, clientContextTakeover=True,
+                 memLevel=8, level=6, minSize=64):
+        # zlib cannot produce a raw deflate stream with an 8 bit window
+        if not 9 <= windowBits <= 15 or not 9 <= clientWindowBits <= 15:
+            raise ValueError('window bits must be between 9 and 15')
+        self.windowBits = windowBits
+        self.clientWindowBits = clientWindowBits
+        self.contextTakeover = contextTakeover
+        self.clientContextTakeover = clientContextTakeover
+        self.memLevel = memLevel
+        self.level = level
+        self.minSize = minSize
+
+    def negotiate(self, offers):
+        """Accept the first usable offer of a Sec-WebSocket-Extensions header
+
+        Returns a PerMessageDeflate and the response header value, or
+        (None, None) when no offer can be accepted.
+        """
+        for offer in offers.split(','):
+            params = [param.strip() for param in offer.split(';')]
+            if params[0] != 'permessage-deflate':
+                continue
+            accepted = self._accept(params[1:])
+            if accepted is not None:
+                return accepted
+        return None, None
+
+    def _accept(self, params):
+        windowBits = self.windowBits
+        clientWindowBits = None
+        contextTakeover = self.contextTakeover
+        clientContextTakeover = self.clientContextTakeover
+
+        seen = set()
+        for param in params:
+            name, _, value = param.partition('=')
+            name = name.strip()
+            value = value.strip().strip('"')
+            if name in seen:
+                return None
+            seen.add(name)
+
+            if name == 'server_no_context_takeover' and not value:
+                contextTakeover = False
+            elif name == 'client_no_context_takeover' and not value:
+                clientContextTakeover = False
+            elif name == 'server_max_window_bits':
+                bits = _windowBits(value)
+                if bits is None or bits < 9:
+                    return None
+                windowBits = min(windowBits, bits)
+            elif name == 'client_max_window_bits':
+                bits = _windowBits(value) if value else 15
+                if bits is None:
+                    return None
+                clientWindowBits = min(self.clientWindowBits, bits)
+            else:
+                return None
+
+        if clientWindowBits is None:
+            # the client did not offer to limit its window, so it may use
+            # the full 32 KiB
+            if self.clientWindowBits < 15:
+                return None
+            clientWindowBits = 15
+
+        response = ['permessage-deflate']
+        if not contextTakeover:
+            response.append('server_no_context_takeover')
+        if not clientContextTakeover:
+            response.append('client_no_context_takeover')
+        # a limit the client asked for is always confirmed (RFC 7692 7.1.2.1)
+        if windowBits < 15 or 'server_max_window_bits' in seen:
+            response.append('server_max_window_bits=%d' % windowBits)
+        if 'client_max_window_bits' in seen:
+            response.append('client_max_window_bits=%d' % clientWindowBits)
+
+        deflate = PerMessageDeflate(self, windowBits, clientWindowBits,
+                                    contextTakeover, clientContextTakeover)
+        return deflate, '; '.join(response)
+
+
+class BufferPool(object):
+    """A bounded free list of equally sized bytearrays
+
+    take() hands out a spare buffer or a new one and give() keeps it for
+    the next take() unless limit buffers are spare already. Nothing may
+    hold on to a buffer, or a view of it, once it is given back.
+    """
+
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+        self.free = []
+
+    def take(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def give(self, buff):
+        if len(self.free) < self.limit:
+            self.free.append(buff)
+
+
+# client reads of all connections, one is in use at a time per thread
+RECV_BUFFERS = BufferPool(RECVSIZE, RECVSPARE)
+
+
+class PerMessageDeflate(object):
+    """Negotiated permessage-deflate state of one connection
+
+    Both directions are streamed, a message may be compressed or inflated
+    a fragment or a received span at a time.
+    """
+
+    def __init__(self, options, windowBits, clientWindowBits,
+                 contextTakeover, clientContextTakeover):
+        self.minSize = options.minSize
+        self.level = options.level
+        self.memLevel = options.memLevel
+        self.windowBits = windowBits
+        self.clientWindowBits = clientWindowBits
+        self.contextTakeover = contextTakeover
+        self.clientContextTakeover = clientContextTakeover
+        self.compressor = None
+        self.decompressor = None
+
+    def compress(self, data, final):
+        """Deflate the next part of a message sent to the client."""
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                               -self.windowBits,
+                                               self.memLevel)
+        data = (self.compressor.compress(bytes(data)) +
+                self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        if final:
+            # the receiver appends the empty stored block again
+            data = data[:-4]
+            if not self.contextTakeover:
+                self.compressor = None
+        return data
+
+    def decompress(self, data, final, limit):
+        """Inflate the next part of a received message
+
+        Raises ExcceedSize once the message would inflate to more than
+        limit bytes.
+        """
+        if self.decompressor is None:
+            # zlib needs at least a 9 bit window to inflate raw streams
+            self.decompressor = zlib.decompressobj(
+                -max(self.clientWindowBits, 9))
+        data = bytes(data)
+        if final:
+            data += b'\x00\x00\xff\xff'
+        try:
+            data = self.decompressor.decompress(data, limit)
+        except zlib.error as e:
+            raise exceptions.InflateError(str(e))
+        if self.decompressor.unconsumed_tail:
+            raise exceptions.ExcceedSize('Inflated payload')
+        if final and not self.clientContextTakeover:
+            self.decompressor = None
+        return data
+
 
 class WebSocket(object):
+    # most sessions sit idle for hours, keep them small; subclasses that
+    # do not declare __slots__ get a __dict__ for their own attributes
+    __slots__ = (
+        'server', 'client', 'address', 'handshaked', 'headerbuffer',
+        'headerscan', 'headertoread', 'fin', 'data', 'opcode', 'hasmask',
+        'maskarray', 'length', 'index', 'framebuffer', 'request',
+        'usingssl', 'frag_start', 'frag_type', 'frag_buffer',
+        'frag_decoder', 'closed', 'sendq', 'sendoffset', 'sendqbytes',
+        'writeWanted', 'target', 'headerid', 'pingsent', 'inbound',
+        'outbound', 'state', 'maxheader', 'maxpayload', 'deflateOptions',
+        'deflate', 'compressed', 'inflated', 'deflating', 'statsPath',
+        'streaming')
+
     def __init__(self, server, sock, address):
         self.server = server
         self.client = sock
         self.address = address
 
         self.handshaked = False
+        # dropped with the parsed request once the handshake is done
         self.headerbuffer = bytearray()
+        # headerbuffer was searched for the blank line up to here
+        self.headerscan = 0
         self.headertoread = 2048
 
         self.fin = 0
-        self.data = bytearray()
+        # payload of the frame being received
+        self.data = None
         self.opcode = 0
         self.hasmask = 0
         self.maskarray = None
         self.length = 0
-        self.lengtharray = None
         self.index = 0
+        # start of a frame header split across reads, if any
+        self.framebuffer = None
         self.request = None
         self.usingssl = False
 
         self.frag_start = False
         self.frag_type = BINARY
         self.frag_buffer = None
-        self.frag_decoder = \
-            codecs.getincrementaldecoder('utf-8')(errors='strict')
+        # created by the first fragmented Text message, see _fragDecoder()
+        self.frag_decoder = None
         self.closed = False
-        self.sendq = deque()
+        # a deque while frames are waiting, None when there are none
+        self.sendq = None
+        self.sendoffset = 0
+        # bytes waiting in sendq, checked against the proxy watermarks
+        self.sendqbytes = 0
+        # called when sendq stops being empty, the proxy arms the socket
+        # for writing then
+        self.writeWanted = None
         self.target = None
         self.headerid = None
+        # when the unanswered PING went out, see sendPing()
+        self.pingsent = None
+
+        # FrameRelay streams, client to upstream and upstream to client,
+        # set up by the proxy in relay mode
+        self.inbound = None
+        self.outbound = None
 
         self.state = HEADERB1
 
@@ -104,6 +662,23 @@ class WebSocket(object):
         self.maxheader = MAXHEADER
         self.maxpayload = MAXPAYLOAD
 
+        # permessage-deflate offered to the client, None to disable it, and
+        # the state negotiated in the handshake
+        self.deflateOptions = None
+        self.deflate = None
+        # the message being received is compressed, bytes inflated so far
+        self.compressed = False
+        self.inflated = 0
+        # the fragmented message being sent is compressed
+        self.deflating = False
+
+        # served instead of upgrading, None to disable, see metrics
+        self.statsPath = STATS_PATH
+
+        # deliver data frames to handleFragment() as they are parsed
+        # instead of reassembling messages for handleMessage()
+        self.streaming = False
+
     def handleMessage(self):
         """message handling
 
@@ -113,6 +688,16 @@ class WebSocket(object):
         """
         pass
 
+    def handleFragment(self, data, opcode, final):
+        """streamed message handling
+
+        Called with each piece of a message as it arrives when
+        self.streaming is set. opcode is the TEXT or BINARY type of the
+        message, data a unicode object or a bytearray object, and final is
+        True for the last piece.
+        """
+        pass
+
     def handleConnected(self):
         """client connection
 
@@ -158,11 +743,10 @@ class WebSocket(object):
 
             self.frag_type = self.opcode
             self.frag_start = True
-            self.frag_decoder.reset()
 
             if self.frag_type == TEXT:
                 self.frag_buffer = []
-                utf_str = self.frag_decoder.decode(self.data, final=False)
+                utf_str = self._fragDecoder().decode(self.data, final=False)
                 if utf_str:
                     self.frag_buffer.append(utf_str)
             else:
@@ -193,7 +777,6 @@ class WebSocket(object):
                 self.data = self.frag_buffer
             self.handleMessage()
 
-            self.frag_decoder.reset()
             self.frag_type = BINARY
             self.frag_start = False
             self.frag_buffer = None
@@ -202,7 +785,7 @@ class WebSocket(object):
             self._sendMessage(False, PONG, self.data)
 
         elif self.opcode == PONG:
-            pass
+            self.pingsent = None
 
         else:
             if self.frag_start is True:
@@ -215,6 +798,42 @@ class WebSocket(object):
                     raise exceptions.InvalidUtf8Payload()
             self.handleMessage()
 
+    def _handleChunk(self, chunk, first, last):
+        if first:
+            if self.opcode == STREAM:
+                if self.frag_start is False:
+                    raise exceptions.FragmentProtocolError()
+            else:
+                if self.frag_start is True:
+                    raise exceptions.FragmentProtocolError()
+                self.frag_type = self.opcode
+                self.frag_start = True
+                if self.frag_type == TEXT:
+                    self._fragDecoder()
+
+        final = last and self.fin != 0
+        data = chunk
+        if self.frag_type == TEXT:
+            try:
+                data = self.frag_decoder.decode(bytes(chunk), final=final)
+            except UnicodeDecodeError:
+                raise exceptions.InvalidUtf8Payload()
+        if data or final:
+            self.handleFragment(data, self.frag_type, final)
+
+        if final:
+            self.frag_type = BINARY
+            self.frag_start = False
+
+    def _fragDecoder(self):
+        # a fresh decoder for a Text message that arrives in pieces
+        if self.frag_decoder is None:
+            self.frag_decoder = \
+                codecs.getincrementaldecoder('utf-8')(errors='strict')
+        else:
+            self.frag_decoder.reset()
+        return self.frag_decoder
+
     def _handlePacket(self):
         if self.opcode == CLOSE:
             pass
@@ -240,44 +859,146 @@ class WebSocket(object):
             self._handleValidInfo()
 
     def _handleData(self, proxy):
+        # FrameRelay queues views of the bytes it is fed, they have to
+        # outlive the read; everything else is copied out of the pooled
+        # buffer before it goes back
+        buff = None
+        if self.inbound is None:
+            buff = RECV_BUFFERS.take()
+        try:
+            size = RECVSIZE if self.handshaked is True else self.headertoread
+            try:
+                if buff is None:
+                    data = self.client.recv(size)
+                    count = len(data)
+                else:
+                    count = self.client.recv_into(buff, size)
+                    data = memoryview(buff)[:count]
+            except _SSL_WANT:
+                return
+            except socket.error as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return
+                raise
+            if not count:
+                raise exceptions.RemoteSocketClose()
+            self._processData(data, proxy)
+        finally:
+            if buff is not None:
+                RECV_BUFFERS.give(buff)
+
+        # the rest of a TLS record is already decrypted and poll() will
+        # not report it
+        if self.usingssl and not self.closed and self.client.pending():
+            self._handleData(proxy)
+
+    def _processData(self, data, proxy):
+        metrics.CLIENT_BYTES_IN.inc(len(data))
         # do normal data
         if self.handshaked is True:
-            data = self.client.recv(16384)
-            if not data:
-                raise exceptions.RemoteSocketClose()
-            for d in data:
-                self._parseMessage(ord(d))
+            if self.inbound is not None:
+                self.inbound.feed(data)
+            else:
+                self._parseMessage(data)
 
         # else do the HTTP header and handshake
         else:
-            data = self.client.recv(self.headertoread)
-            if not data:
-                raise exceptions.RemoteSocketClose()
+            if self.closed:
+                # answered without upgrading, the connection is ending
+                return
+
+            # accumulate
+            self.headerbuffer.extend(data)
+
+            if len(self.headerbuffer) >= self.maxheader:
+                self.headerbuffer = None
+                self._rejectHandshake(BAD_REQUEST_STR)
+                return
+
+            # indicates end of HTTP header, only look at the bytes that
+            # were not searched before
+            end = self.headerbuffer.find(b'\r\n\r\n',
+                                         max(0, self.headerscan - 3))
+            if end < 0:
+                self.headerscan = len(self.headerbuffer)
+            else:
+                header = self.headerbuffer[:end]
+                rest = self.headerbuffer[end + 4:]
+                self.headerbuffer = None
+
+                # handshake rfc 6455
+                try:
+                    key = self._checkRequest(header)
+                    if key is None:
+                        return
+                    k = key.encode('ascii') + GUID_STR.encode('ascii')
+                    k_s = base64.b64encode(
+                        hashlib.sha1(k).digest()).decode('ascii')
+                    hStr = HANDSHAKE_STR % {'acceptstr': k_s}
+                    offers = self.request.headers.get(
+                        'Sec-WebSocket-Extensions')
+                    if offers and self.deflateOptions is not None:
+                        self.deflate, response = \
+                            self.deflateOptions.negotiate(offers)
+                        if response is not None:
+                            hStr = (hStr[:-2] + EXTENSIONS_STR % response +
+                                    '\r\n')
+                    self._appendFrame(BINARY, (hStr.encode('ascii'),))
+                    self.headerid = self.request.headers['User-Agent']
+                    self.handshaked = True
+                    metrics.HANDSHAKES.inc()
+                    self.handleConnected()
+                    proxy._attachTarget(self)
+                except Exception as e:
+                    raise exceptions.HandshakeFailed(str(e))
+                finally:
+                    # only handleConnected() gets to look at the request
+                    self.request = None
+
+                # frames the client sent right behind its request
+                if rest:
+                    self._processData(rest, proxy)
+
+    def _checkRequest(self, header):
+        """Parse the upgrade request and return its key
+
+        Returns None when the request got an answer instead: the stats,
+        426 Upgrade Required for a Sec-WebSocket-Version other than 13 or
+        400 Bad Request for anything else that is not a valid upgrade.
+        """
+        try:
+            self.request = HTTPRequest(header)
+            if self._isStatsRequest():
+                self._sendStats()
+                return None
+            return self.request.checkUpgrade()
+        except ValueError:
+            version = None
+            if self.request is not None:
+                version = self.request.headers.get('Sec-WebSocket-Version')
+            if version is not None and version != '13':
+                self._rejectHandshake(UPGRADE_REQUIRED_STR)
             else:
-                # accumulate
-                self.headerbuffer.extend(data)
-
-                if len(self.headerbuffer) >= self.maxheader:
-                    raise exceptions.ExcceedSize("Header length")
-
-                # indicates end of HTTP header
-                if b'\r\n\r\n' in self.headerbuffer:
-                    self.request = HTTPRequest(self.headerbuffer)
-
-                    # handshake rfc 6455
-                    try:
-                        key = self.request.headers['Sec-WebSocket-Key']
-                        k = key.encode('ascii') + GUID_STR.encode('ascii')
-                        k_s = base64.b64encode(
-                            hashlib.sha1(k).digest()).decode('ascii')
-                        hStr = HANDSHAKE_STR % {'acceptstr': k_s}
-                        self.sendq.append((BINARY, hStr.encode('ascii')))
-                        self.headerid = self.request.headers['User-Agent']
-                        self.handshaked = True
-                        self.handleConnected()
-                        proxy.listeners.append(self.target.ws)
-                    except Exception as e:
-                        raise exceptions.HandshakeFailed(str(e))
+                self._rejectHandshake(BAD_REQUEST_STR)
+            return None
+
+    def _rejectHandshake(self, response):
+        # queued like the stats, so the connection ends once it is sent
+        self._appendFrame(CLOSE, (response.encode('ascii'),))
+        self.closed = True
+
+    def _isStatsRequest(self):
+        request = self.request
+        return (self.statsPath is not None and request.command == 'GET' and
+                request.path == self.statsPath and
+                'websocket' not in request.headers.tokens('Upgrade'))
+
+    def _sendStats(self):
+        body = metrics.REGISTRY.render().encode('ascii')
+        header = (STATS_STR % len(body)).encode('ascii')
+        # queued like a Close frame so the connection ends once it is sent
+        self._appendFrame(CLOSE, (header, body))
+        self.closed = True
 
     def close(self, status=1000, reason=u''):
         """Websocket close
@@ -300,30 +1021,88 @@ class WebSocket(object):
         finally:
             self.closed = True
 
-    def _sendBuffer(self, buff, send_all=False):
-        size = len(buff)
-        tosend = size
-        already_sent = 0
+    def _flushSendq(self):
+        """Write out queued frames
+
+        Gathers as many queued frames as fit into IOV_MAX buffers and
+        SENDBUDGET bytes into a single sendmsg call, resuming at
+        self.sendoffset inside the first frame. A frame may end up split
+        between calls, a relayed one can hold thousands of buffers. Stops
+        when the socket would block. Raises ReceivedClientClose once a
+        Close frame has been sent.
+
+        Without sendmsg (Python 2 and SSL sockets) the buffers have to be
+        joined into one copy, so only buffers that fit SENDBUDGET
+        together are; a larger one is sent on its own without copying.
+        """
+        # SSL sockets have no sendmsg()
+        gather = _HAS_SENDMSG and not self.usingssl
+        while self.sendq:
+            views = []
+            size = 0
+            skip = self.sendoffset
+            full = False
+            for opcode, frame in self.sendq:
+                for buff in frame:
+                    length = len(buff) - skip
+                    if length <= 0:
+                        skip = -length
+                        continue
+                    if not gather and views and size + length > SENDBUDGET:
+                        full = True
+                        break
+                    views.append(memoryview(buff)[skip:])
+                    size += length
+                    skip = 0
+                    if size >= SENDBUDGET or len(views) >= IOV_MAX:
+                        full = True
+                        break
+                if full or opcode == CLOSE:
+                    break
 
-        while tosend > 0:
             try:
-                # i should be able to send a bytearray
-                sent = self.client.send(buff[already_sent:])
+                if gather:
+                    sent = self.client.sendmsg(views)
+                elif len(views) == 1:
+                    sent = self.client.send(views[0])
+                else:
+                    sent = self.client.send(
+                        b''.join([view.tobytes() for view in views]))
                 if sent == 0:
                     raise RuntimeError('socket connection broken')
+                metrics.CLIENT_BYTES_OUT.inc(sent)
 
-                already_sent += sent
-                tosend -= sent
-
+            except _SSL_WANT:
+                return
             except socket.error as e:
                 # if full buffers then wait for them to drain and try again
                 if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
-                    if send_all:
-                        continue
-                    return buff[already_sent:]
+                    return
                 else:
-                    raise exceptions.sockerError(str(e))
-        return None
+                    raise exceptions.SockerError(str(e))
+
+            # drop the frames that went out completely
+            offset = self.sendoffset + sent
+            while self.sendq:
+                opcode, frame = self.sendq[0]
+                length = 0
+                for buff in frame:
+                    length += len(buff)
+                if offset < length:
+                    break
+                offset -= length
+                self.sendq.popleft()
+                self.sendqbytes -= length
+                if opcode == CLOSE:
+                    self.sendoffset = 0
+                    raise exceptions.ReceivedClientClose()
+            self.sendoffset = offset
+
+            if sent < size:
+                # the socket buffer is full
+                return
+        # an idle connection keeps no empty deque around
+        self.sendq = None
 
     def sendFragmentStart(self, data):
         """Begin send data fragment
@@ -338,7 +1117,8 @@ class WebSocket(object):
         opcode = BINARY
         if _check_unicode(data):
             opcode = TEXT
-        self._sendMessage(True, opcode, data)
+        self.deflating = self.deflate is not None
+        self._sendMessage(True, opcode, data, self.deflating)
 
     def sendFragment(self, data):
         """see sendFragmentStart()
@@ -346,7 +1126,7 @@ class WebSocket(object):
         If data is a unicode object then the frame is sent as Text.
         If the data is a bytearray object then the frame is sent as Binary.
         """
-        self._sendMessage(True, STREAM, data)
+        self._sendMessage(True, STREAM, data, self.deflating)
 
     def sendFragmentEnd(self, data):
         """see sendFragmentEnd()
@@ -354,213 +1134,177 @@ class WebSocket(object):
         If data is a unicode object then the frame is sent as Text.
         If the data is a bytearray object then the frame is sent as Binary.
         """
-        self._sendMessage(False, STREAM, data)
+        self._sendMessage(False, STREAM, data, self.deflating)
+        self.deflating = False
 
     def sendMessage(self, data):
         """Send websocket data frame to the client.
 
         If data is a unicode object then the frame is sent as Text.
         If the data is a bytearray object then the frame is sent as Binary.
+        The payload is queued without a copy, so a bytearray must not be
+        modified afterwards.
         """
         opcode = BINARY
         if _check_unicode(data):
             opcode = TEXT
+            data = data.encode('utf-8')
         if data:
-            self._sendMessage(False, opcode, data)
-
-    def _sendMessage(self, fin, opcode, data):
+            compress = (self.deflate is not None and
+                        len(data) >= self.deflate.minSize)
+            self._sendMessage(False, opcode, data, compress)
 
-        payload = bytearray()
+    def sendPing(self, when, data=b''):
+        """Send a PING, when is the time it counts as outstanding from."""
+        self._sendMessage(False, PING, data)
+        self.pingsent = when
 
-        b1 = 0
-        b2 = 0
-        if fin is False:
-            b1 |= 0x80
-        b1 |= opcode
+    def sendFrame(self, frame):
+        """Queue a message framed by encodeFrame()."""
+        opcode, buffers = frame
+        self._queueFrame(opcode, buffers)
 
+    def _sendMessage(self, fin, opcode, data, compress=False):
         if _check_unicode(data):
             data = data.encode('utf-8')
 
+        if compress:
+            data = self.deflate.compress(data, fin is False)
         length = len(data)
-        payload.append(b1)
-
-        if length <= 125:
-            b2 |= length
-            payload.append(b2)
-
-        elif length >= 126 and length <= 65535:
-            b2 |= 126
-            payload.append(b2)
-            payload.extend(struct.pack("!H", length))
-
-        else:
-            b2 |= 127
-            payload.append(b2)
-            payload.extend(struct.pack("!Q", length))
+        # only the first frame of a message carries RSV1
+        header = _encodeHeader(fin, opcode, length,
+                               compressed=compress and opcode != STREAM)
 
+        # header and payload stay separate buffers until the gather write
         if length > 0:
-            payload.extend(data)
-
-        self.sendq.append((opcode, payload))
-
-    def _parseHEADERB1(self, byte):
-        self.fin = byte & 0x80
-        self.opcode = byte & 0x0F
-        self.state = HEADERB2
+            self._queueFrame(opcode, (header, data))
+        else:
+            self._queueFrame(opcode, (header,))
+
+    def _queueFrame(self, opcode, frame):
+        metrics.CLIENT_FRAMES_OUT.inc()
+        if self.outbound is not None:
+            # never split a frame the relay is forwarding from upstream,
+            # nor a fragmented message with a message of our own
+            if opcode in (CLOSE, PING, PONG):
+                self.outbound.deferControl(self._appendFrame, opcode, frame)
+            else:
+                self.outbound.defer(self._appendFrame, opcode, frame)
+        else:
+            self._appendFrame(opcode, frame)
+
+    def _appendFrame(self, opcode, frame):
+        wanted = not self.sendq
+        if self.sendq is None:
+            self.sendq = deque()
+        self.sendq.append((opcode, frame))
+        for buff in frame:
+            self.sendqbytes += len(buff)
+        if wanted and self.writeWanted is not None:
+            self.writeWanted()
+
+    def _parseHeader(self, data, offset, size):
+        header = _decodeHeader(data, offset, size)
+        if header is None:
+            return offset
+
+        fin, opcode, rsv, hasmask, length, mask, headerlen = header
+        metrics.CLIENT_FRAMES_IN.inc()
+        self.fin = fin
+        self.opcode = opcode
+        self.hasmask = hasmask
+        self.length = length
+        self.maskarray = mask
 
         self.index = 0
-        self.length = 0
-        self.lengtharray = bytearray()
         self.data = bytearray()
 
-        rsv = byte & 0x70
         if rsv != 0:
-            raise exceptions.RSVBitError()
-
-    def _parseHEADERB2(self, byte):
-        mask = byte & 0x80
-        length = byte & 0x7F
-
-        if self.opcode == PING and length > 125:
+            if (rsv != RSV1 or self.deflate is None or
+                    opcode not in (TEXT, BINARY)):
+                raise exceptions.RSVBitError()
+        if opcode in (TEXT, BINARY):
+            self.compressed = rsv != 0
+            self.inflated = 0
+
+        if opcode == PING and length > 125:
             raise exceptions.ExcceedSize("Ping Packet length")
 
-        if mask == 128:
-            self.hasmask = True
-        else:
-            self.hasmask = False
-
-        if length <= 125:
-            self.length = length
-
-            # if we have a mask we must read it
-            if self.hasmask is True:
-                self.maskarray = bytearray()
-                self.state = MASK
-            else:
-                # if there is no mask and no payload we are done
-                if self.length <= 0:
-                    try:
-                        self._handlePacket()
-                    finally:
-                        self.state = self.HEADERB1
-                        self.data = bytearray()
-
-                # we have no mask and some payload
-                else:
-                    self.data = bytearray()
-                    self.state = PAYLOAD
-
-        elif length == 126:
-            self.lengtharray = bytearray()
-            self.state = LENGTHSHORT
-
-        elif length == 127:
-            self.lengtharray = bytearray()
-            self.state = LENGTHLONG
-
-    def _praseLengthShort(self, byte):
-        self.lengtharray.append(byte)
-
-        if len(self.lengtharray) > 2:
-            raise exceptions.ExcceedSize('short length')
-
-        if len(self.lengtharray) == 2:
-            self.length = struct.unpack_from('!H', self.lengtharray)[0]
-
-            if self.hasmask is True:
-                self.maskarray = bytearray()
-                self.state = MASK
-            else:
-                # if there is no mask and no payload we are done
-                if self.length <= 0:
-                    try:
-                        self._handlePacket()
-                    finally:
-                        self.state = HEADERB1
-                        self.data = bytearray()
-
-                # we have no mask and some payload
-                else:
-                    self.data = bytearray()
-                    self.state = PAYLOAD
-
-    def _parseLengthLong(self, byte):
-        self.lengtharray.append(byte)
-
-        if len(self.lengtharray) > 8:
-            raise exceptions.ExcceedSize('Long length')
-
-        if len(self.lengtharray) == 8:
-            self.length = struct.unpack_from('!Q', self.lengtharray)[0]
+        # if length exceeds allowable size then remove the connection
+        if length >= self.maxpayload:
+            raise exceptions.ExcceedSize('Payload')
 
-            if self.hasmask is True:
-                self.maskarray = bytearray()
-                self.state = MASK
+        if length <= 0:
+            # if there is no payload we are done
+            if self.compressed and opcode in (STREAM, TEXT, BINARY):
+                self.data = bytearray(self._inflate(b'', fin != 0))
+            if self.streaming and opcode in (STREAM, TEXT, BINARY):
+                self._handleChunk(self.data, True, True)
             else:
-                # if there is no mask and no payload we are done
-                if self.length <= 0:
-                    try:
-                        self._handlePacket()
-                    finally:
-                        self.state = HEADERB1
-                        self.data = bytearray()
-
-                # we have no mask and some payload
-                else:
-                    self.data = bytearray()
-                    self.state = PAYLOAD
-
-    def _parseMask(self, byte):
-        self.maskarray.append(byte)
+                self._handlePacket()
+        else:
+            self.state = PAYLOAD
+        return offset + headerlen
 
-        if len(self.maskarray) > 4:
-            raise exceptions.ExcceedSize('mask length')
+    def _parsePayload(self, data, offset, size):
+        end = min(size, offset + self.length - self.index)
+        chunk = data[offset:end]
 
-        if len(self.maskarray) == 4:
-            # if there is no mask and no payload we are done
-            if self.length <= 0:
-                try:
-                    self._handlePacket()
-                finally:
-                    self.state = HEADERB1
-                    self.data = bytearray()
+        if self.hasmask:
+            chunk = _unmask(chunk, self.maskarray, self.index)
 
-                    # we have no mask and some payload
-            else:
-                self.data = bytearray()
-                self.state = PAYLOAD
+        first = self.index == 0
+        self.index += end - offset
+        last = self.index == self.length
+        isdata = self.opcode in (STREAM, TEXT, BINARY)
+        if self.compressed and isdata:
+            chunk = self._inflate(chunk, last and self.fin != 0)
 
-    def _parsePayload(self, byte):
-        if self.hasmask is True:
-            self.data.append(byte ^ self.maskarray[self.index % 4])
-        else:
-            self.data.append(byte)
+        if self.streaming and isdata:
+            if last:
+                self.state = HEADERB1
+            self._handleChunk(bytearray(chunk), first, last)
+            return end
 
-        # if length exceeds allowable size then remove the connection
-        if len(self.data) >= self.maxpayload:
-            raise exceptions.ExcceedSize('Payload')
+        self.data.extend(chunk)
 
         # check if we have processed length bytes; if so we are done
-        if (self.index + 1) == self.length:
+        if last:
             try:
                 self._handlePacket()
             finally:
                 self.state = HEADERB1
-                self.data = bytearray()
-        else:
-            self.index += 1
-
-    def _parseMessage(self, byte):
-        # read in the header
-        if self.state == HEADERB1:
-            self._parseHEADERB1(byte)
-        elif self.state == HEADERB2:
-            self._parseHEADERB2(byte)
-        elif self.state == LENGTHSHORT:
-            self._praseLengthShort()
-        elif self.state == LENGTHLONG:
-            self._parseLengthLong(byte)
-        elif self.state == MASK:
-            self._parseMask(byte)
-        elif self.state == PAYLOAD:
-            self._parsePayload(byte)
+                self.data = None
+        return end
+
+    def _inflate(self, chunk, final):
+        limit = self.maxpayload - self.inflated
+        if limit <= 0:
+            raise exceptions.ExcceedSize('Inflated payload')
+        if isinstance(chunk, memoryview):
+            chunk = chunk.tobytes()
+        chunk = self.deflate.decompress(chunk, final, limit)
+        self.inflated += len(chunk)
+        return chunk
+
+    def _parseMessage(self, data):
+        # prepend the incomplete header left over from the previous read
+        if self.framebuffer:
+            self.framebuffer.extend(data)
+            data = self.framebuffer
+            self.framebuffer = None
+        # payload spans are sliced without copying
+        data = memoryview(data)
+
+        offset = 0
+        size = len(data)
+        while offset < size:
+            if self.state == HEADERB1:
+                consumed = self._parseHeader(data, offset, size)
+                if consumed == offset:
+                    # wait for the rest of the header
+                    self.framebuffer = bytearray(data[offset:])
+                    break
+                offset = consumed
+            else:
+                offset = self._parsePayload(data, offset, size)
@@ -16,8 +16,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from collections import deque
 import errno
-import exceptions
 import fcntl
 import logging
 import os
@@ -25,13 +25,19 @@ import select
 import signal
 import six
 import socket
+import ssl
 import struct
 import sys
 import termios
+import threading
 import time
 import tty
 import websocket
 
+from . import exceptions
+from . import metrics
+from . import websocketbase
+
 
 LOG = logging.getLogger(__name__)
 
@@ -39,24 +45,54 @@ DEFAULT_API_VERSION = '1'
 DEFAULT_ENDPOINT_TYPE = 'publicURL'
 DEFAULT_SERVICE_TYPE = 'container'
 
+# not exported by the socket module of older interpreters
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+# buffers handed to one sendmsg() call by flush()
+SENDBATCH = 64
+# bytes read from the attach socket at a time
+RECVSIZE = 16384
+
 
 class WebSocketClient(object):
+    # one per proxied session, keep it small
+    __slots__ = ('escape', 'close_wait', 'host_url', 'pool', 'cs', 'ws',
+                 'sendq', 'sendoffset', 'sendqbytes', 'recvbuf',
+                 'recvoffset', 'recvopcode', 'recvparts', 'poll',
+                 'start_of_line', 'read_escape', 'quit', 'old_settings')
 
     def __init__(self, host_url, escape='~',
-                 close_wait=0.5):
+                 close_wait=0.5, pool=None):
         self.escape = escape
         self.close_wait = close_wait
         self.host_url = host_url
+        # UpstreamPool to open the attach socket through, if any
+        self.pool = pool
         self.cs = None
-
-    def connect(self):
+        self.ws = None
+        # framed bytes waiting for the attach socket, see flush(), None
+        # when there are none
+        self.sendq = None
+        self.sendoffset = 0
+        self.sendqbytes = 0
+        # bytes read but not parsed yet, see handle_recv(), and the
+        # fragments of an unfinished message
+        self.recvbuf = bytearray()
+        self.recvoffset = 0
+        self.recvopcode = None
+        self.recvparts = []
+
+    def create_connection(self):
+        """Open the attach websocket and return it without keeping it
+
+        Safe to call from a ConnectPool worker thread.
+        """
         url = self.host_url
         LOG.debug('connecting to: %s', url)
         try:
-            self.ws = websocket.create_connection(url,
-                                                  skip_utf8_validation=True)
-            print('connected and press Enter to continue')
-            print('type %s. to disconnect' % self.escape)
+            if self.pool is not None:
+                return self.pool.connect(url)
+            return websocket.create_connection(url,
+                                               skip_utf8_validation=True)
         except socket.error as e:
             raise exceptions.ConnectionFailed(e)
         except websocket.WebSocketConnectionClosedException as e:
@@ -64,6 +100,176 @@ class WebSocketClient(object):
         except websocket.WebSocketBadStatusException as e:
             raise exceptions.ConnectionFailed(e)
 
+    def connect(self):
+        self.ws = self.create_connection()
+        print('connected and press Enter to continue')
+        print('type %s. to disconnect' % self.escape)
+
+    def attach(self, ws):
+        """Adopt a websocket opened by create_connection()
+
+        Frames queued by send() while the connection was pending are
+        written out in order.
+        """
+        self.ws = ws
+        self.flush()
+
+    def attach_ready(self):
+        """Attach a socket the pool established ahead of time
+
+        Returns False when there is none and create_connection() has to
+        run.
+        """
+        if self.pool is None:
+            return False
+        ws = self.pool.take(self.host_url)
+        if ws is None:
+            return False
+        self.attach(ws)
+        return True
+
+    def send(self, data):
+        """Send data upstream without blocking
+
+        Text is sent as a Text frame and anything else as Binary, the same
+        way WebSocket.sendMessage() picks the opcode. Whatever the socket
+        does not take right away stays in sendq for flush().
+        """
+        if isinstance(data, six.text_type):
+            opcode = websocket.ABNF.OPCODE_TEXT
+        else:
+            data = bytes(data)
+            opcode = websocket.ABNF.OPCODE_BINARY
+        frame = websocket.ABNF.create_frame(data, opcode)
+        self.send_raw((frame.format(),))
+
+    def send_raw(self, buffers):
+        """Queue already framed bytes upstream, see FrameRelay."""
+        if self.sendq is None:
+            self.sendq = deque()
+        for buff in buffers:
+            self.sendq.append(buff)
+            self.sendqbytes += len(buff)
+        if self.ws is not None:
+            self.flush()
+
+    def flush(self):
+        """Write queued bytes until the attach socket would block
+
+        Returns True once sendq is empty.
+        """
+        sock = self.ws.sock
+        while self.sendq:
+            views = []
+            skip = self.sendoffset
+            for buff in self.sendq:
+                views.append(memoryview(buff)[skip:])
+                skip = 0
+                if len(views) >= SENDBATCH:
+                    break
+
+            try:
+                if isinstance(sock, ssl.SSLSocket):
+                    sent = self._send_tls(sock, views)
+                elif hasattr(sock, 'sendmsg'):
+                    sent = sock.sendmsg(views, [], MSG_DONTWAIT)
+                else:
+                    sent = sock.send(views[0], MSG_DONTWAIT)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return False
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise exceptions.ConnectionFailed(e)
+
+            self.sendqbytes -= sent
+            metrics.UPSTREAM_BYTES_OUT.inc(sent)
+            offset = self.sendoffset + sent
+            while self.sendq and offset >= len(self.sendq[0]):
+                offset -= len(self.sendq.popleft())
+            self.sendoffset = offset
+        self.sendq = None
+        return True
+
+    def _send_tls(self, sock, views):
+        # SSL sockets take neither send flags nor buffer lists, and a
+        # write that has to wait must be retried with the same bytes,
+        # which sendq and sendoffset guarantee. Only buffers that fit
+        # SENDBUDGET together are joined, a larger first one goes out
+        # without a copy.
+        data = views[0]
+        size = len(data)
+        count = 1
+        while (count < len(views) and
+               size + len(views[count]) <= websocketbase.SENDBUDGET):
+            size += len(views[count])
+            count += 1
+        if count > 1:
+            data = b''.join([view.tobytes() for view in views[:count]])
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return sock.send(data)
+        finally:
+            sock.settimeout(timeout)
+
+    def pending(self):
+        """Bytes already decrypted by TLS, which poll() does not see."""
+        sock = self.ws.sock
+        if isinstance(sock, ssl.SSLSocket):
+            return sock.pending()
+        return 0
+
+    def recv_raw(self, bufsize=RECVSIZE):
+        """Read raw frame bytes from the attach socket without blocking
+
+        Returns None when there is nothing to read, which a TLS socket
+        also does while it holds only part of a record.
+        """
+        sock = self.ws.sock
+        try:
+            if isinstance(sock, ssl.SSLSocket):
+                data = self._recv_tls(sock, bufsize)
+            else:
+                data = sock.recv(bufsize, MSG_DONTWAIT)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return None
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise exceptions.ConnectionFailed(e)
+        if not data:
+            raise exceptions.Disconnected()
+        return data
+
+    def _recv_tls(self, sock, bufsize):
+        # SSL sockets take no recv flags, see _send_tls()
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return sock.recv(bufsize)
+        finally:
+            sock.settimeout(timeout)
+
+    def close(self, send_close=True):
+        """Close the attach socket
+
+        Queue a Close frame behind whatever is still in sendq, write what
+        the socket takes without blocking and shut it down. send_close
+        False skips the frame, for a relay that stopped inside a frame.
+        """
+        if self.ws is None:
+            return
+        if send_close:
+            frame = websocket.ABNF.create_frame(
+                struct.pack('!H', websocket.STATUS_NORMAL),
+                websocket.ABNF.OPCODE_CLOSE)
+            try:
+                self.send_raw((frame.format(),))
+            except Exception:
+                pass
+        self.ws.shutdown()
+
     def start_loop(self):
         self.poll = select.poll()
         self.poll.register(sys.stdin,
@@ -180,12 +386,96 @@ class WebSocketClient(object):
             return
         return data
 
-    def handle_recv(self):
-        data = self.ws.recv()
-        LOG.debug('read %s (%d bytes) from websocket from container',
-                  repr(data), len(data))
-        if not data:
-            return
+    def handle_recv(self, read=True):
+        """Return the next message from the attach socket, or None
+
+        Frames are parsed from what recv_raw() read so far. Only when no
+        message is complete there, and read is True, the socket is read
+        once more without blocking, so one readable event can yield many
+        messages and a frame that arrives in pieces never blocks: keep
+        calling with read False until it returns None.
+
+        Text comes back as unicode and anything else as bytes. Raises
+        exceptions.Disconnected when the upstream sent a Close frame.
+
+        PINGs are answered here instead of by websocket-client, which
+        would write to the socket behind sendq and could block the loop
+        or put the PONG inside a partly written frame.
+        """
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                if not read:
+                    return None
+                read = False
+                data = self.recv_raw()
+                if data is None:
+                    return None
+                if self.recvoffset:
+                    del self.recvbuf[:self.recvoffset]
+                    self.recvoffset = 0
+                self.recvbuf.extend(data)
+                continue
+
+            data = self._handle_frame(*frame)
+            if data is not None:
+                LOG.debug('read %s (%d bytes) from websocket from container',
+                          repr(data), len(data))
+                return data
+
+    def _next_frame(self):
+        buff = self.recvbuf
+        header = websocketbase._decodeHeader(buff, self.recvoffset,
+                                             len(buff))
+        if header is None:
+            return None
+        fin, opcode, rsv, hasmask, length, mask, headerlen = header
+        start = self.recvoffset + headerlen
+        if len(buff) - start < length:
+            return None
+        payload = bytes(buff[start:start + length])
+        if mask is not None:
+            payload = websocketbase._unmask(payload, mask)
+        self.recvoffset = start + length
+        return fin, opcode, payload
+
+    def _handle_frame(self, fin, opcode, payload):
+        if opcode in (websocket.ABNF.OPCODE_CLOSE, websocket.ABNF.OPCODE_PING,
+                      websocket.ABNF.OPCODE_PONG):
+            if len(payload) > 125:
+                raise exceptions.ControlFrameOverLimit()
+            if not fin:
+                raise exceptions.MessageFragmentFail()
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                raise exceptions.Disconnected()
+            if opcode == websocket.ABNF.OPCODE_PING:
+                pong = websocket.ABNF.create_frame(
+                    payload, websocket.ABNF.OPCODE_PONG)
+                # send() queues whole frames, so this follows a frame
+                # boundary
+                self.send_raw((pong.format(),))
+            return None
+
+        if opcode == websocket.ABNF.OPCODE_CONT:
+            if self.recvopcode is None:
+                raise exceptions.FragmentProtocolError()
+        elif opcode in (websocket.ABNF.OPCODE_TEXT,
+                        websocket.ABNF.OPCODE_BINARY):
+            if self.recvopcode is not None:
+                raise exceptions.FragmentProtocolError()
+            self.recvopcode = opcode
+        else:
+            raise exceptions.UnknownOPCCode(opcode)
+
+        self.recvparts.append(payload)
+        if not fin:
+            return None
+        opcode = self.recvopcode
+        data = b''.join(self.recvparts)
+        self.recvopcode = None
+        self.recvparts = []
+        if opcode == websocket.ABNF.OPCODE_TEXT:
+            return data.decode('utf-8')
         return data
 
     def handle_resize(self):
@@ -242,6 +532,313 @@ class WebSocketClient(object):
         self.cs.containers.resize(self.id, width, height)
 
 
+class ConnectPool(object):
+    """Bounded pool of threads opening upstream attach sockets
+
+    Blocking DNS, TCP connect and HTTP upgrade run on the workers so the
+    proxy loop keeps serving other sessions. Every finished connect writes
+    a byte to the wakeup pipe; the loop polls wakeupfd and collects the
+    results with completed().
+    """
+
+    def __init__(self, workers=4):
+        self.requests = six.moves.queue.Queue()
+        self.results = deque()
+        self.wakeupfd, self.notifyfd = os.pipe()
+        for fd in (self.wakeupfd, self.notifyfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._run,
+                                      name='connect-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, key, target):
+        """Queue target.create_connection() for a worker."""
+        self.requests.put((key, target))
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            key, target = request
+            ws = None
+            error = None
+            try:
+                ws = target.create_connection()
+            except Exception as e:
+                error = e
+            self.results.append((key, target, ws, error))
+
+            try:
+                os.write(self.notifyfd, b'x')
+            except OSError as e:
+                # a full pipe already guarantees a wakeup
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def completed(self):
+        """Return the (key, target, ws, error) tuples finished so far."""
+        try:
+            while os.read(self.wakeupfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        done = []
+        while self.results:
+            done.append(self.results.popleft())
+        return done
+
+    def close(self):
+        for worker in self.workers:
+            self.requests.put(None)
+        os.close(self.wakeupfd)
+        os.close(self.notifyfd)
+
+
+def _alive(sock):
+    """Check without blocking that the peer has not closed an idle socket."""
+    try:
+        return bool(sock.recv(1, socket.MSG_PEEK | MSG_DONTWAIT))
+    except socket.error as e:
+        return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+    except ValueError:
+        # SSL sockets refuse recv flags, let the first read find out
+        return True
+
+
+class UpstreamPool(object):
+    """Upstream connections shared by WebSocketClient instances
+
+    Resolved addresses are cached for dns_ttl seconds. For every ws:// host
+    seen, spare connected TCP sockets are kept so that an attach only pays
+    for the HTTP upgrade, and URLs passed to warm() get complete attach
+    sockets ahead of time. A background thread refills both every interval
+    seconds and right after something was handed out.
+
+    wss:// URLs are handshaked with ssl_context, by default one that
+    verifies the server certificate, over the same spare TCP sockets. The
+    last TLS session of every host is kept and offered on the next
+    connect, so most attaches resume instead of a full TLS handshake.
+
+    The thread starts on first use in every process, so a pool created
+    before the Supervisor forks is not shared between workers.
+    """
+
+    def __init__(self, dns_ttl=30, spare=0, interval=1.0,
+                 connect_timeout=5, ssl_context=None):
+        self.dns_ttl = dns_ttl
+        self.spare = spare
+        self.interval = interval
+        self.connect_timeout = connect_timeout
+        self.ssl_context = ssl_context
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # (host, port) -> (expiry, getaddrinfo result)
+        self.addresses = {}
+        # (host, port) -> deque of connected sockets
+        self.idle = {}
+        # (host, port) -> TLS session to resume
+        self.sessions = {}
+        # url -> number of attach sockets to keep, and the ready ones
+        self.hot = {}
+        self.ready = {}
+        self.pid = None
+        self.closed = False
+
+    def _start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # sockets inherited over fork belong to the parent
+            for idle in self.idle.values():
+                for sock in idle:
+                    sock.close()
+                idle.clear()
+            for ready in self.ready.values():
+                for ws in ready:
+                    ws.sock.close()
+                ready.clear()
+            self.pid = os.getpid()
+
+        thread = threading.Thread(target=self._maintain,
+                                  name='upstream-pool')
+        thread.daemon = True
+        thread.start()
+
+    def resolve(self, host, port):
+        """getaddrinfo() for a TCP connection, cached for dns_ttl."""
+        key = (host, port)
+        now = time.time()
+        with self.lock:
+            entry = self.addresses.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self.lock:
+            self.addresses[key] = (now + self.dns_ttl, infos)
+        return infos
+
+    def _open(self, host, port):
+        error = None
+        for family, socktype, proto, _, address in self.resolve(host, port):
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(self.connect_timeout)
+            try:
+                sock.connect(address)
+            except socket.error as e:
+                sock.close()
+                error = e
+                continue
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+
+        # resolve again next time, the host may have moved
+        with self.lock:
+            self.addresses.pop((host, port), None)
+        if error is None:
+            error = socket.error('no address for %s' % host)
+        raise error
+
+    def _tcp(self, host, port):
+        key = (host, port)
+        with self.lock:
+            idle = self.idle.setdefault(key, deque())
+            while idle:
+                sock = idle.popleft()
+                if _alive(sock):
+                    self.wakeup.set()
+                    return sock
+                sock.close()
+        return self._open(host, port)
+
+    def _tls(self, sock, host, port):
+        if self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        options = {'server_hostname': host}
+        with self.lock:
+            session = self.sessions.get((host, port))
+        if session is not None:
+            # Python 2 has no session resumption on the client side
+            options['session'] = session
+        sock.settimeout(self.connect_timeout)
+        try:
+            sock = self.ssl_context.wrap_socket(sock, **options)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    def _upgrade(self, url):
+        parsed = six.moves.urllib.parse.urlparse(url)
+        options = {'skip_utf8_validation': True}
+        if parsed.scheme == 'ws':
+            options['socket'] = self._tcp(parsed.hostname, parsed.port or 80)
+        elif parsed.scheme == 'wss':
+            key = (parsed.hostname, parsed.port or 443)
+            options['socket'] = self._tls(self._tcp(*key), *key)
+        ws = websocket.create_connection(url, **options)
+
+        if parsed.scheme == 'wss':
+            # a TLS 1.3 session ticket only arrives with the upgrade
+            # response
+            session = getattr(ws.sock, 'session', None)
+            if session is not None:
+                with self.lock:
+                    self.sessions[key] = session
+        return ws
+
+    def connect(self, url):
+        """Open an attach websocket to url, using whatever is ready."""
+        self._start()
+        ws = self.take(url)
+        if ws is None:
+            ws = self._upgrade(url)
+        return ws
+
+    def warm(self, url, count=1):
+        """Keep count attach sockets to url established ahead of time
+
+        A count of 0 stops warming url.
+        """
+        self._start()
+        with self.lock:
+            if count > 0:
+                self.hot[url] = count
+            else:
+                self.hot.pop(url, None)
+        self.wakeup.set()
+
+    def take(self, url):
+        """Return an attach socket to url established ahead, or None."""
+        with self.lock:
+            ready = self.ready.get(url)
+            while ready:
+                ws = ready.popleft()
+                if _alive(ws.sock):
+                    self.wakeup.set()
+                    return ws
+                ws.shutdown()
+        return None
+
+    def _refill(self):
+        if self.spare > 0:
+            with self.lock:
+                wanted = [(key, self.spare - len(idle))
+                          for key, idle in self.idle.items()]
+            for (host, port), missing in wanted:
+                for i in range(missing):
+                    sock = self._open(host, port)
+                    with self.lock:
+                        self.idle[(host, port)].append(sock)
+
+        with self.lock:
+            wanted = [(url, count - len(self.ready.get(url, ())))
+                      for url, count in self.hot.items()]
+        for url, missing in wanted:
+            for i in range(missing):
+                ws = self._upgrade(url)
+                with self.lock:
+                    self.ready.setdefault(url, deque()).append(ws)
+
+    def _maintain(self):
+        while not self.closed:
+            try:
+                self._refill()
+            except Exception:
+                LOG.debug('refilling the upstream pool failed',
+                          exc_info=True)
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        with self.lock:
+            for idle in self.idle.values():
+                for sock in idle:
+                    sock.close()
+            for ready in self.ready.values():
+                for ws in ready:
+                    ws.shutdown()
+            self.idle.clear()
+            self.ready.clear()
+
+
 class WINCHHandler(object):
     """WINCH Signal handler
 
@@ -18,113 +18,673 @@
 
 
 import errno
-import exceptions
+import functools
+import select
 import socket
 import sys
-import websocket
-import websocketbase
+import time
 
-from select import select
+from . import exceptions
+from . import metrics
+from . import timers
+from . import tls
+from . import websocketbase
+from .poller import createPoller, READ, WRITE
+from .routes import createResolver
+from .websocketclient import ConnectPool
+
+# not exported by the socket module of older interpreters
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# bytes queued for one side of a session before the proxy stops reading
+# the other side, and the level at which it reads again
+HIGHWATERMARK = 1048576
+LOWWATERMARK = 262144
+
+# seconds a client may stay silent before it is sent a PING, and before
+# its session is closed as dead
+PINGINTERVAL = 30
+IDLETIMEOUT = 90
+
+
+# who may write to a shared upstream, see WebSocketProxy
+STDIN_ALL = 'all'
+STDIN_FIRST = 'first'
+STDIN_NONE = 'none'
+
+
+class ConnectionPair(object):
+    """The client socket of one session and the Upstream it reads from."""
+
+    __slots__ = ('client', 'clientfd', 'upstream', 'clientpaused',
+                 'lastseen', 'timer', 'tlsPending')
+
+    def __init__(self, client, clientfd):
+        self.client = client
+        self.clientfd = clientfd
+        self.upstream = None
+        # reads stopped because the upstream is backlogged
+        self.clientpaused = False
+        # last time the client sent anything, and its keepalive timer
+        self.lastseen = None
+        self.timer = None
+        # the TLS handshake with the client is not finished yet
+        self.tlsPending = False
+
+
+class Upstream(object):
+    """An attach socket and the sessions it feeds
+
+    Every session has its own Upstream unless the proxy shares them, then
+    all sessions for the same target URL read from one attach socket.
+    """
+
+    __slots__ = ('key', 'target', 'fd', 'connecting', 'connectstart',
+                 'paused', 'pairs')
+
+    def __init__(self, key, target):
+        self.key = key
+        self.target = target
+        self.fd = None
+        self.connecting = False
+        self.connectstart = None
+        # reads stopped because a client is backlogged
+        self.paused = False
+        self.pairs = []
+
+
+class Viewer(object):
+    """The target of a session on a shared Upstream
+
+    Data the session sends is dropped unless the stdin policy of the proxy
+    lets it write; everything else is the shared WebSocketClient's.
+    """
+
+    def __init__(self, proxy, upstream, pair):
+        self.proxy = proxy
+        self.upstream = upstream
+        self.pair = pair
+
+    def send(self, data):
+        if self.proxy._mayWrite(self.upstream, self.pair):
+            self.upstream.target.send(data)
+
+    def send_raw(self, buffers):
+        if self.proxy._mayWrite(self.upstream, self.pair):
+            self.upstream.target.send_raw(buffers)
+
+    def close(self):
+        # the proxy closes the upstream when its last session leaves
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.upstream.target, name)
 
 
 class WebSocketProxy(object):
-    def __init__(self, host, port, websocketclass, selectInterval=0.1):
+    def __init__(self, host, port, websocketclass, selectInterval=None,
+                 poller=None, connectWorkers=4, reusePort=False, relay=False,
+                 highWatermark=HIGHWATERMARK, lowWatermark=LOWWATERMARK,
+                 routes=None, shareUpstreams=False, stdinPolicy=STDIN_ALL,
+                 pingInterval=PINGINTERVAL, idleTimeout=IDLETIMEOUT,
+                 tls=None, deflate=None):
         self.websocketclass = websocketclass
+        # tls.ServerTLS to serve wss:// with, None for plain ws://
+        self.tls = tls
+        # route ID -> upstream URL, see routes.createResolver()
+        self.routes = createResolver(routes) if routes is not None else None
+        if lowWatermark > highWatermark:
+            raise ValueError('lowWatermark above highWatermark')
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        # forward frames opaquely instead of decoding messages
+        self.relay = relay
+        if relay and shareUpstreams:
+            raise ValueError('relayed sessions cannot share an upstream')
+        # websocketbase.DeflateOptions offered to every client, None
+        # leaves permessage-deflate off
+        if relay and deflate is not None:
+            raise ValueError('relayed frames cannot be compressed')
+        self.deflate = deflate
+        # one attach socket per target URL for all sessions, and who of
+        # them may write to it: STDIN_ALL, STDIN_FIRST (the oldest session
+        # still open), STDIN_NONE or a callable(client, clients)
+        self.shareUpstreams = shareUpstreams
+        self.stdinPolicy = stdinPolicy
+        # target URL -> shared Upstream
+        self.shared = {}
         self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            # several worker processes bind the same port and the kernel
+            # balances incoming connections between them
+            self.serversocket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.serversocket.bind((host, port))
-        self.serversocket.listen(5)
+        # a reconnect storm must not overflow the accept queue, dropped
+        # SYNs are only retried after a second
+        self.serversocket.listen(socket.SOMAXCONN)
+        self.serversocket.setblocking(0)
+        # longest poll wait, None sleeps until the next event or timer
         self.selectInterval = selectInterval
+        # keepalive PINGs and dead client eviction, None disables either
+        self.pingInterval = pingInterval
+        self.idleTimeout = idleTimeout
+        self.timers = timers.TimerWheel()
+        # loop time, updated once per poll
+        self.now = timers.now()
         self.connections = {}
-        self.listeners = [self.serversocket]
+        # shared counter updated with len(self.connections), see Supervisor
+        self.counter = None
+        # client fd -> ConnectionPair, upstream fd -> Upstream
+        self.pairs = {}
+        self.upstreams = {}
+        self.poller = poller if poller is not None else createPoller()
+        self.interest = {}
+        self._register(self.serversocket, READ)
+        self.connector = ConnectPool(connectWorkers)
+        self._register(self.connector.wakeupfd, READ)
+
+        metrics.REGISTRY.gauge('websocketproxy_connections',
+                               'Open client connections',
+                               lambda: len(self.connections))
+        metrics.REGISTRY.gauge('websocketproxy_sendq_bytes',
+                               'Bytes queued for all clients',
+                               self._sendqBytes)
 
     def _constructWebSocket(self, sock, address):
-        return self.websocketclass(self, sock, address)
+        client = self.websocketclass(self, sock, address)
+        if self.relay:
+            # relayed frames are never decoded, so they cannot be compressed
+            client.deflateOptions = None
+        elif self.deflate is not None:
+            client.deflateOptions = self.deflate
+        return client
+
+    def _register(self, fileobj, events):
+        self.poller.register(fileobj, events)
+        self.interest[fileobj] = events
+
+    def _unregister(self, fileobj):
+        self.poller.unregister(fileobj)
+        self.interest.pop(fileobj, None)
+
+    def _setInterest(self, fileobj, events):
+        # only touch the kernel when the interest set really changes
+        if self.interest.get(fileobj) != events:
+            self.poller.modify(fileobj, events)
+            self.interest[fileobj] = events
+
+    def _paused(self, paused, backlog):
+        if backlog >= self.highWatermark:
+            return True
+        if backlog <= self.lowWatermark:
+            return False
+        return paused
+
+    def _updateInterest(self, pair):
+        """Poll each side of a session according to the other's backlog
+
+        Reading from a side stops once the bytes queued for the opposite
+        side reach highWatermark and starts again when they drain to
+        lowWatermark, so a slow peer holds back its partner instead of
+        growing the queues without bound.
+
+        Only called for the sessions an event touched; queueing for an
+        idle client arms it through writeWanted, see _armWrite().
+        """
+        client = pair.client
+        if pair.upstream is not None:
+            pair.clientpaused = self._paused(
+                pair.clientpaused, pair.upstream.target.sendqbytes)
+
+        events = 0 if pair.clientpaused else READ
+        if client.sendq:
+            events |= WRITE
+        self._setInterest(pair.clientfd, events)
+
+    def _updateUpstreamInterest(self, upstream):
+        # a shared upstream goes at the pace of its slowest session
+        backlog = 0
+        for pair in upstream.pairs:
+            backlog = max(backlog, pair.client.sendqbytes)
+        upstream.paused = self._paused(upstream.paused, backlog)
+
+        events = 0 if upstream.paused else READ
+        if upstream.target.sendq:
+            events |= WRITE
+        self._setInterest(upstream.fd, events)
+
+    def _armWrite(self, pair):
+        fd = pair.clientfd
+        if self.pairs.get(fd) is pair:
+            self._setInterest(fd, self.interest.get(fd, 0) | WRITE)
+
+    def _refreshPair(self, pair):
+        # both sides after the session read or wrote, unless it was closed
+        if self.pairs.get(pair.clientfd) is not pair:
+            return
+        self._updateInterest(pair)
+        upstream = pair.upstream
+        if upstream is not None and upstream.fd is not None:
+            self._updateUpstreamInterest(upstream)
+
+    def _refreshUpstream(self, upstream):
+        # an upstream read or write changes the backlog of its sessions
+        if self.upstreams.get(upstream.fd) is not upstream:
+            return
+        self._updateUpstreamInterest(upstream)
+        for pair in upstream.pairs:
+            self._updateInterest(pair)
+
+    def _mayWrite(self, upstream, pair):
+        policy = self.stdinPolicy
+        if policy == STDIN_ALL:
+            return True
+        if policy == STDIN_FIRST:
+            return upstream.pairs[0] is pair
+        if policy == STDIN_NONE:
+            return False
+        return policy(pair.client, [p.client for p in upstream.pairs])
+
+    def _startRelay(self, client):
+        client.outbound = websocketbase.FrameRelay(
+            functools.partial(self._relayToClient, client),
+            functools.partial(self._upstreamControl, client))
+        client.inbound = websocketbase.FrameRelay(
+            client.target.send_raw,
+            functools.partial(self._clientControl, client))
+
+    def _relayToClient(self, client, buffers):
+        client._appendFrame(websocketbase.STREAM, tuple(buffers))
+
+    def _clientControl(self, client, opcode, payload):
+        if opcode == websocketbase.PING:
+            client._sendMessage(False, websocketbase.PONG, payload)
+        elif opcode == websocketbase.PONG:
+            client.pingsent = None
+        elif opcode == websocketbase.CLOSE:
+            client.data = payload
+            client._handleOPCClose()
+
+    def _upstreamControl(self, client, opcode, payload):
+        if opcode == websocketbase.PING:
+            frame = websocketbase._encodeMaskedFrame(websocketbase.PONG,
+                                                     payload)
+            client.inbound.deferControl(client.target.send_raw, frame)
+        elif opcode == websocketbase.CLOSE:
+            # pass the upstream close status on to the client
+            client.data = payload
+            client._handleOPCClose()
+
+    def _attachTarget(self, client):
+        pair = self.pairs[client.client.fileno()]
+        if self.relay:
+            self._startRelay(client)
+
+        upstream = None
+        if self.shareUpstreams:
+            key = client.target.host_url
+            upstream = self.shared.get(key)
+            if upstream is None:
+                upstream = self.shared[key] = Upstream(key, client.target)
+            client.target = Viewer(self, upstream, pair)
+        else:
+            upstream = Upstream(None, client.target)
+        pair.upstream = upstream
+        upstream.pairs.append(pair)
+        if len(upstream.pairs) > 1:
+            # joined an upstream that is connected or connecting
+            return
+
+        target = upstream.target
+        if target.ws is None and not target.attach_ready():
+            # connect in the background; client frames are buffered by
+            # the target until the attach socket is up
+            upstream.connecting = True
+            upstream.connectstart = time.time()
+            self.connector.submit(upstream, target)
+            return
+        self._registerUpstream(upstream)
+
+    def _registerUpstream(self, upstream):
+        upstream.fd = upstream.target.ws.fileno()
+        self.upstreams[upstream.fd] = upstream
+        self._register(upstream.fd, READ)
+        # frames buffered while connecting may not all be written yet
+        self._refreshUpstream(upstream)
+
+    def _handleConnected(self):
+        for upstream, target, ws, error in self.connector.completed():
+            upstream.connecting = False
+            if not upstream.pairs:
+                # every client went away while we were connecting
+                if ws is not None:
+                    ws.shutdown()
+                continue
+
+            if error is not None:
+                # later sessions for the target try again from scratch
+                self._forgetUpstream(upstream)
+                for pair in upstream.pairs:
+                    pair.client.close(1011, u'upstream connect failed')
+                continue
+
+            metrics.UPSTREAM_CONNECT_SECONDS.observe(
+                time.time() - upstream.connectstart)
+            try:
+                target.attach(ws)
+                self._registerUpstream(upstream)
+            except Exception:
+                for pair in list(upstream.pairs):
+                    self._closeConnection(pair)
+
+    def broadcast(self, data, connections=None):
+        """Send one message to many clients, framing it only once
+
+        connections defaults to every client past the handshake. Each
+        sendq holds the same buffers and keeps only its own write offset.
+        Returns the number of clients the message was queued for.
+        """
+        if connections is None:
+            connections = self.connections.values()
+        frame = websocketbase.encodeFrame(data)
+        count = 0
+        for client in connections:
+            if client.handshaked and not client.closed:
+                client.sendFrame(frame)
+                count += 1
+        return count
+
+    def _continueTLS(self, pair):
+        """Advance the non-blocking TLS handshake of a client
+
+        The socket is polled for the direction OpenSSL waits on until the
+        handshake is done, then the session goes on like a plain one.
+        """
+        sock = pair.client.client
+        try:
+            sock.do_handshake()
+        except tls.WANTREAD:
+            self._setInterest(pair.clientfd, READ)
+            return
+        except tls.WANTWRITE:
+            self._setInterest(pair.clientfd, WRITE)
+            return
+        except Exception:
+            self._closeConnection(pair)
+            return
+
+        pair.tlsPending = False
+        tls.countHandshake(sock)
+        try:
+            # the upgrade request may have come with the last handshake
+            # record, then the socket is not readable anymore
+            pair.client._handleData(self)
+        except Exception:
+            self._closeConnection(pair)
+            return
+        self._refreshPair(pair)
+
+    def _startTimer(self, pair):
+        pair.lastseen = self.now
+        if self.pingInterval is None and self.idleTimeout is None:
+            return
+        pair.timer = self.timers.schedule(self._nextCheck(pair),
+                                          self._checkIdle, pair)
+
+    def _nextCheck(self, pair):
+        deadlines = []
+        if self.idleTimeout is not None:
+            deadlines.append(pair.lastseen + self.idleTimeout)
+        if self.pingInterval is not None:
+            if pair.client.pingsent is None:
+                deadlines.append(pair.lastseen + self.pingInterval)
+            else:
+                # look again after the PONG may have arrived
+                deadlines.append(self.now + self.pingInterval)
+        return min(deadlines)
+
+    def _checkIdle(self, pair):
+        """Timer callback of a session
+
+        Reads only record pair.lastseen, the timer is moved here when it
+        fires early, so busy sessions never touch the wheel.
+        """
+        client = pair.client
+        silent = self.now - pair.lastseen
+        if self.idleTimeout is not None and silent >= self.idleTimeout:
+            if client.handshaked:
+                try:
+                    client.close(1001, u'idle timeout')
+                    client._flushSendq()
+                except Exception:
+                    pass
+            self._closeConnection(pair)
+            return
+
+        if (self.pingInterval is not None and silent >= self.pingInterval and
+                client.pingsent is None and client.handshaked and
+                not client.closed):
+            try:
+                client.sendPing(self.now)
+            except Exception:
+                self._closeConnection(pair)
+                return
+        self.timers.reschedule(pair.timer, self._nextCheck(pair))
+
+    def _sendqBytes(self):
+        return sum(client.sendqbytes for client in self.connections.values())
+
+    def _countConnections(self):
+        if self.counter is not None:
+            self.counter.value = len(self.connections)
+
+    def _forgetUpstream(self, upstream):
+        if self.shared.get(upstream.key) is upstream:
+            del self.shared[upstream.key]
+
+    def _closeUpstream(self, upstream, sendClose=True):
+        self._forgetUpstream(upstream)
+        if upstream.fd is not None:
+            self.upstreams.pop(upstream.fd, None)
+            self._unregister(upstream.fd)
+        upstream.target.close(sendClose)
+
+    def _closeConnection(self, pair):
+        if pair.timer is not None:
+            self.timers.cancel(pair.timer)
+        self.pairs.pop(pair.clientfd, None)
+        self._unregister(pair.clientfd)
+        del self.connections[pair.clientfd]
+        self._countConnections()
+
+        client = pair.client
+        client.client.close()
+        upstream = pair.upstream
+        if upstream is not None:
+            upstream.pairs.remove(pair)
+            if not upstream.pairs:
+                # a Close frame inside a relayed frame would corrupt it
+                inbound = client.inbound
+                self._closeUpstream(
+                    upstream, inbound is None or not inbound.midFrame())
+            elif upstream.fd is not None:
+                # it may have waited for this session to drain
+                self._updateUpstreamInterest(upstream)
+        elif client.target is not None:
+            client.target.close()
+        client.handleClose()
+
+    def _upstreamClosed(self, upstream, status, reason):
+        # tell the clients why before their sockets go
+        for pair in list(upstream.pairs):
+            client = pair.client
+            if client.handshaked and not client.closed:
+                try:
+                    client.close(status, reason)
+                    client._flushSendq()
+                except Exception:
+                    pass
+            self._closeConnection(pair)
+
+    def _handleUpstream(self, upstream):
+        while True:
+            read = True
+            while True:
+                # a read may complete several messages or none, and does
+                # not block on a frame that is still arriving
+                try:
+                    if self.relay:
+                        data = upstream.target.recv_raw() if read else None
+                    else:
+                        data = upstream.target.handle_recv(read)
+                except exceptions.Disconnected:
+                    self._upstreamClosed(upstream, 1000, u'upstream closed')
+                    return
+                except Exception:
+                    self._upstreamClosed(upstream, 1011, u'upstream failed')
+                    return
+                read = False
+                if data is None:
+                    break
+
+                metrics.UPSTREAM_BYTES_IN.inc(len(data))
+                for pair in list(upstream.pairs):
+                    client = pair.client
+                    try:
+                        if self.relay:
+                            client.outbound.feed(data)
+                        else:
+                            client.sendMessage(data)
+                    except Exception:
+                        self._closeConnection(pair)
+                if self.upstreams.get(upstream.fd) is not upstream:
+                    return
+
+            if self.upstreams.get(upstream.fd) is not upstream:
+                return
+            # the rest of a TLS record is already decrypted and poll()
+            # will not report it
+            if not upstream.target.pending():
+                break
+        self._refreshUpstream(upstream)
 
     def close(self):
+        self.connector.close()
         self.serversocket.close()
         for desc, conn in self.connections.items():
             conn.close()
             conn.handleClose()
+        # last, closing a connection still arms its write interest
+        self.poller.close()
+
+    def _accept(self):
+        # take every connection that is waiting, not one per poll
+        while True:
+            try:
+                sock, address = self.serversocket.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.errno in (errno.ECONNABORTED, errno.EINTR):
+                    continue
+                raise exceptions.SockerError(str(e))
+            self._acceptSocket(sock, address)
+
+    def _acceptSocket(self, sock, address):
+        try:
+            sock.setblocking(0)
+            fileno = sock.fileno()
+            if self.tls is not None:
+                sock = self.tls.wrap(sock)
+            client = self._constructWebSocket(sock, address)
+            client.usingssl = self.tls is not None
+            self.connections[fileno] = client
+            pair = self.pairs[fileno] = ConnectionPair(client, fileno)
+            pair.tlsPending = client.usingssl
+            client.writeWanted = functools.partial(self._armWrite, pair)
+            self._register(fileno, READ)
+            self._startTimer(pair)
+            self._countConnections()
+        except Exception as n:
+            if sock is not None:
+                sock.close()
+            raise exceptions.SockerError(str(n))
 
     def _handlerList(self, rList):
+        accept = False
         for ready in rList:
-            if isinstance(ready, websocket._core.WebSocket):
-                for fileno in self.listeners:
-                    if isinstance(fileno, int):
-                        client = self.connections[fileno]
-                        if ready == client.target.ws:
-                            data = client.target.handle_recv()
-                            client.sendMessage(data)
-
             if ready == self.serversocket:
-                try:
-                    sock, address = self.serversocket.accept()
-                    fileno = sock.fileno()
-                    self.connections[fileno] = \
-                        self._constructWebSocket(sock, address)
-                    self.listeners.append(fileno)
-                except Exception as n:
-                    if sock is not None:
-                        sock.close()
-                    raise exceptions.SockerError(str(n))
-
-            if isinstance(ready, int):
-                client = self.connections[ready]
-                try:
-                    client._handleData(self)
-                except Exception as n:
-                    client.client.close()
-                    client.handleClose()
-                    del self.connections[ready]
-                    self.listeners.remove(ready)
+                # accept last so a new socket never reuses an fd that still
+                # has a stale event later in this list
+                accept = True
+                continue
+
+            if ready == self.connector.wakeupfd:
+                self._handleConnected()
+                continue
+
+            upstream = self.upstreams.get(ready)
+            if upstream is not None:
+                self._handleUpstream(upstream)
+                continue
+
+            pair = self.pairs.get(ready)
+            if pair is None:
+                continue
+            pair.lastseen = self.now
+            if pair.tlsPending:
+                self._continueTLS(pair)
+                continue
+            try:
+                pair.client._handleData(self)
+            except Exception:
+                self._closeConnection(pair)
+                continue
+            self._refreshPair(pair)
+
+        if accept:
+            self._accept()
 
     def _handlewList(self, wList):
         for ready in wList:
-            client = self.connections[ready]
+            upstream = self.upstreams.get(ready)
+            if upstream is not None:
+                try:
+                    upstream.target.flush()
+                except Exception:
+                    for pair in list(upstream.pairs):
+                        self._closeConnection(pair)
+                    continue
+                self._refreshUpstream(upstream)
+                continue
+
+            pair = self.pairs.get(ready)
+            if pair is None:
+                continue
+            if pair.tlsPending:
+                self._continueTLS(pair)
+                continue
             try:
-                while client.sendq:
-                    opcode, payload = client.sendq.popleft()
-                    remaining = client._sendBuffer(payload)
-                    if remaining is not None:
-                        client.sendq.appendleft((opcode, remaining))
-                        break
-                    else:
-                        if opcode == websocketbase.CLOSE:
-                            raise exceptions.ReceivedClientClose()
+                pair.client._flushSendq()
             except Exception:
-                client.client.close()
-                client.handleClose()
-                del self.connections[ready]
-                self.listeners.remove(ready)
-
-    def _handlexList(self, xList):
-        for failed in xList:
-            if failed == self.serversocket:
-                self.close()
-                raise exceptions.SockerError("client failed")
-            else:
-                if failed not in self.connections:
-                    continue
-                client = self.connections[failed]
-                client.client.close()
-                client.handleClose()
-                del self.connections[failed]
-                self.listeners.remove(failed)
+                self._closeConnection(pair)
+                continue
+            # disarms the socket once sendq is empty
+            self._refreshPair(pair)
 
     def proxy(self):
         while True:
-            writers = []
-            for fileno in self.listeners:
-                if isinstance(fileno, int):
-                    client = self.connections[fileno]
-                    if client.sendq:
-                        writers.append(fileno)
+            timeout = self.selectInterval
+            deadline = self.timers.nextDeadline()
+            if deadline is not None:
+                wait = max(0, deadline - timers.now())
+                if timeout is None or wait < timeout:
+                    timeout = wait
 
             try:
-                rList, wList, xList = select(self.listeners, writers,
-                                             [], self.selectInterval)
-            except (select.error, OSError):
+                events = self.poller.poll(timeout)
+            except (select.error, IOError, OSError):
                 exc = sys.exc_info()[1]
                 if hasattr(exc, 'errno'):
                     err = exc.errno
@@ -135,8 +695,18 @@ class WebSocketProxy(object):
                 else:
                     continue
 
+            start = time.time()
+            self.now = timers.now()
+            rList = []
+            wList = []
+            for fileobj, mask in events:
+                if mask & READ:
+                    rList.append(fileobj)
+                if mask & WRITE:
+                    wList.append(fileobj)
+
             self._handlewList(wList)
 
             self._handlerList(rList)
-
-            self._handlexList(xList)
+            self.timers.expire(self.now)
+            metrics.LOOP_SECONDS.observe(time.time() - start)